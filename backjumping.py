@@ -0,0 +1,400 @@
+'''Conflict-directed backjumping (CBJ) and nogood learning.
+
+   CBJ(csp) is a BT whose search, after a deadend, jumps straight back to
+   the most recent decision to blame for it instead of undoing the
+   decisions in order. Blame is kept as sets of decision levels, stored
+   as bitmasks (bit L for the decision at level L):
+
+   - every value pruned during search gets a reason, the levels whose
+     assignments (with the constraints) imply the pruning. Propagators
+     need not help: after each propagation its prunings are replayed in
+     order, and each is blamed on a constraint over the pruned variable
+     that has no support for the value at that point (has_support). The
+     reason is the levels of the assigned variables of that constraint
+     plus the reasons of the values missing from the domains of its
+     other variables. A pruning no constraint explains is blamed on
+     every level.
+   - a failed propagation is blamed in the same way on csp.conflict.
+   - the conflict set of a variable starts as the reasons of the values
+     missing from its domain when it is picked, and collects the blame
+     of each of its values that fails. When all have failed, search
+     jumps to the deepest level of the conflict set, which inherits the
+     rest of it.
+
+   The conflict set of an exhausted variable is also a nogood: the
+   assignments at its levels can never all hold in a solution. Nogoods
+   are kept in a bounded NogoodStore and checked whenever a variable is
+   assigned, before the propagator runs. A nogood whose assignments all
+   hold is a deadend, and one with all but one holding prunes the value
+   of the last one.
+
+   bt_search, bt_solutions and bt_count work as for BT. Below a
+   solution, search backtracks chronologically, so every solution is
+   still enumerated. The nogood store is emptied at the start of each
+   search, as the CSP may have changed in between.
+'''
+from cspbase import BT
+
+
+def levels(mask):
+    '''iterate over the levels whose bits are set in mask, lowest first'''
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class Nogood:
+    '''Assignments [(Variable, value), ...] that cannot all hold in a
+       solution, and the activity of the nogood in its NogoodStore'''
+
+    __slots__ = ('literals', 'activity')
+
+    def __init__(self, literals, activity):
+        self.literals = literals
+        self.activity = activity
+
+
+class NogoodStore:
+    '''Bounded store of learned nogoods.
+
+       A nogood cannot be violated while two of its assignments do not
+       hold, so each nogood is only watched by two of them (its first two
+       literals, as with the watched literals of SAT solvers). When a
+       watched assignment is made, check looks for another literal to
+       watch; only when there is none is the nogood a deadend or does it
+       prune the value of its last literal. Backtracking never has to
+       update the watches.
+
+       Each nogood has an activity, bumped whenever it prunes a value or
+       detects a deadend. The bump grows by 1/decay with every nogood
+       learned, so older activity counts for less (as in SAT solvers).
+       Adding to a full store first evicts its least active half; a new
+       nogood starts with the current bump, so it outranks older unused
+       ones. Nogoods longer than max_size are not stored'''
+
+    def __init__(self, capacity=1000, max_size=None, decay=0.95):
+        self.capacity = capacity
+        self.max_size = max_size
+        self.decay = decay
+        self.nogoods = []
+        self.watch = dict()  # (Variable, value) -> nogoods watching it
+        self.bump = 1.0
+        self.learned = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.nogoods)
+
+    def clear(self):
+        '''forget every nogood (the statistics are kept)'''
+        self.nogoods = []
+        self.watch = dict()
+        self.bump = 1.0
+
+    def add(self, literals):
+        '''Learn the nogood literals, a list of (Variable, value) of
+           which the first two should be the last to be assigned (they
+           are watched first). Return the Nogood, or None if it is not
+           stored'''
+        if self.capacity <= 0 or not literals:
+            return None
+        if self.max_size is not None and len(literals) > self.max_size:
+            return None
+        if len(self.nogoods) >= self.capacity:
+            self.evict()
+        nogood = Nogood(list(literals), self.bump)
+        self.nogoods.append(nogood)
+        self.watch_nogood(nogood)
+        self.learned += 1
+
+        self.bump /= self.decay
+        if self.bump > 1e100:
+            for ng in self.nogoods:
+                ng.activity *= 1e-100
+            self.bump *= 1e-100
+        return nogood
+
+    def watch_nogood(self, nogood):
+        '''Internal routine. Watch the first two literals of nogood'''
+        for literal in nogood.literals[:2]:
+            self.watch.setdefault(literal, []).append(nogood)
+
+    def touch(self, nogood):
+        '''bump the activity of nogood'''
+        nogood.activity += self.bump
+
+    def evict(self):
+        '''Internal routine. Drop the least active half of the nogoods'''
+        keep = sorted(self.nogoods, key=lambda ng: ng.activity, reverse=True)[:self.capacity // 2]
+        self.evicted += len(self.nogoods) - len(keep)
+        self.nogoods = keep
+        self.watch = dict()
+        for nogood in keep:
+            self.watch_nogood(nogood)
+
+    def check(self, var, val):
+        '''Called after var is assigned val. Return (conflict, units):
+           conflict is a nogood whose assignments now all hold, or None;
+           units lists the (nogood, Variable, value) for the nogoods
+           whose assignments all hold but one, of an unassigned variable
+           whose current domain still has the value'''
+        units = []
+        watchers = self.watch.get((var, val))
+        if not watchers:
+            return None, units
+        key = (var, val)
+        still = []  # the nogoods that keep watching var = val
+        conflict = None
+        for nogood in watchers:
+            if conflict is not None:
+                still.append(nogood)
+                continue
+            lits = nogood.literals
+            if len(lits) == 1:
+                still.append(nogood)
+                conflict = nogood
+                continue
+            if lits[0] == key:
+                lits[0], lits[1] = lits[1], lits[0]
+            #lits[1] is var = val, which now holds
+            x, a = lits[0]
+            if x.assignedValue is not None and x.assignedValue != a or not x.curdom >> x.dom_index[a] & 1:
+                #the other watched assignment cannot hold any more
+                still.append(nogood)
+                continue
+            for i in range(2, len(lits)):
+                y, b = lits[i]
+                if y.assignedValue != b:
+                    lits[1], lits[i] = lits[i], lits[1]
+                    self.watch.setdefault(lits[1], []).append(nogood)
+                    break
+            else:
+                still.append(nogood)
+                if x.assignedValue == a:
+                    conflict = nogood
+                else:
+                    units.append((nogood, x, a))
+        self.watch[key] = still
+        return conflict, units
+
+
+class CBJ(BT):
+    '''BT with conflict-directed backjumping and, unless nogoods is
+       False, nogood learning into a NogoodStore(capacity, max_nogood_size).
+       Besides the BT statistics, nBackjumps counts the jumps that skipped
+       at least one level'''
+
+    def __init__(self, csp, nogoods=True, capacity=1000, max_nogood_size=None):
+        BT.__init__(self, csp)
+        self.nogoods = NogoodStore(capacity, max_nogood_size) if nogoods else None
+        self.reasons = dict()  # (Variable, value) pruned -> levels to blame
+        self.level = dict()  # assigned Variable -> its decision level
+        self.nBackjumps = 0
+
+    def clear_stats(self):
+        BT.clear_stats(self)
+        self.nBackjumps = 0
+
+    def print_stats(self):
+        BT.print_stats(self)
+        print("Search made {} backjumps".format(self.nBackjumps), end='')
+        if self.nogoods is not None:
+            print(" and learned {} nogoods ({} evicted)".format(self.nogoods.learned, self.nogoods.evicted))
+        else:
+            print()
+
+    #
+    #explanations
+    #
+
+    def domain_reason(self, var):
+        '''levels to blame for the CURRENT domain of var: its own level if
+           it is assigned, else the reasons of its missing values'''
+        if var.is_assigned():
+            level = self.level.get(var)
+            return 1 << level if level else 0
+        reasons = self.reasons
+        mask = 0
+        missing = var.basedom & ~var.curdom
+        while missing:
+            low = missing & -missing
+            mask |= reasons.get((var, var.dom[low.bit_length() - 1]), 0)
+            missing ^= low
+        return mask
+
+    def constraint_reason(self, constraint, var=None):
+        '''levels to blame for what constraint infers about var from the
+           rest of its scope (for the whole scope if var is None)'''
+        reasons = self.reasons
+        level = self.level
+        mask = 0
+        for v in constraint.scope:
+            if v is var:
+                continue
+            if v.assignedValue is not None:
+                mask |= 1 << level[v] if v in level else 0
+                continue
+            missing = v.basedom & ~v.curdom
+            while missing:
+                low = missing & -missing
+                mask |= reasons.get((v, v.dom[low.bit_length() - 1]), 0)
+                missing ^= low
+        return mask
+
+    def literals_reason(self, literals, var=None):
+        '''levels of the assignments of a nogood, but that of var'''
+        mask = 0
+        for v, _ in literals:
+            if v is not var:
+                mask |= 1 << self.level[v]
+        return mask
+
+    def explain(self, prunings, var, level):
+        '''Record a reason for each of the prunings of the propagation of
+           var at level, by replaying them in order (see the module
+           docstring). The constraints over var are tried first, as they
+           are the culprits of forward checking. The replay flips the
+           domain bits directly: the domains end up as they were, so the
+           DomainBuckets need not follow'''
+        for v, val in prunings:
+            v.curdom |= 1 << v.dom_index[val]
+            v.cursize += 1
+        vars_to_cons = self.csp.vars_to_cons
+        near = set(vars_to_cons[var])
+        reasons = self.reasons
+        every_level = (1 << (level + 1)) - 2
+        for v, val in prunings:
+            reason = every_level
+            cons = vars_to_cons[v]
+            for c in [c for c in cons if c in near] + [c for c in cons if c not in near]:
+                if not c.has_support(v, val):
+                    reason = self.constraint_reason(c, v)
+                    break
+            reasons[(v, val)] = reason
+            v.curdom ^= 1 << v.dom_index[val]
+            v.cursize -= 1
+
+    def propagate(self, propagator, var, val, level):
+        '''Check the nogoods over var = val, then run the propagator and
+           explain its prunings. Returns (status, prunings, blame), blame
+           being the levels to blame if status is False'''
+        pruned = []
+        store = self.nogoods
+        if store is not None:
+            conflict, units = store.check(var, val)
+            if conflict is not None:
+                store.touch(conflict)
+                return False, pruned, self.literals_reason(conflict.literals)
+            for nogood, v, a in units:
+                if v.in_cur_domain(a):
+                    store.touch(nogood)
+                    v.prune_value(a)
+                    pruned.append((v, a))
+                    self.reasons[(v, a)] = self.literals_reason(nogood.literals, v)
+                    if v.cur_domain_size() == 0:
+                        return False, pruned, self.domain_reason(v)
+
+        status, prunings = propagator(self.csp, var)
+        self.explain(prunings, var, level)
+        pruned.extend(prunings)
+        if status:
+            return True, pruned, 0
+        if self.csp.conflict is None:
+            return False, pruned, (1 << (level + 1)) - 2
+        return False, pruned, self.constraint_reason(self.csp.conflict)
+
+    #
+    #search
+    #
+
+    def bt_dfs(self, propagator, var_ord, val_ord):
+        '''Depth first search like BT.bt_dfs, but an exhausted decision
+           jumps back to the deepest level of its conflict set, learning
+           the conflict set as a nogood. Decision frames carry the
+           conflict set as a fifth entry. Bit 0 of a conflict set marks
+           that a solution was found below, which makes every level to
+           blame (chronological backtracking) and is never learned'''
+
+        hooks = self.hooks
+        nvars = len(self.unasgn_vars)
+        self.reasons = dict()
+        self.level = dict()
+        if self.nogoods is not None:
+            self.nogoods.clear()
+        if nvars == 0:
+            if hooks is not None:
+                hooks.solution(self, 0)
+            yield
+            return
+
+        stack = [self.open_frame(var_ord, val_ord, 1)]
+        while stack:
+            level = len(stack)
+            frame = stack[-1]
+            var, value_order, pos, mark, conf = frame
+
+            if var.is_assigned():
+                self.undo(frame, level)
+
+            if pos == len(value_order):
+                #values exhausted: learn the conflict set and jump to its
+                #deepest level, which inherits the rest of it
+                stack.pop()
+                if self.nogoods is not None and not conf & 1:
+                    self.nogoods.add([(stack[j - 1][0], stack[j - 1][0].get_assigned_value())
+                                      for j in reversed(list(levels(conf)))])
+                target = (conf >> 1).bit_length()
+                if target < level - 1:
+                    self.nBackjumps += 1
+                while len(stack) > target:
+                    self.undo(stack.pop(), len(stack) + 1)
+                if stack:
+                    stack[-1][4] |= conf & ~(1 << target)
+                continue
+
+            val = value_order[pos]
+            frame[2] = pos + 1
+
+            var.assign(val)
+            self.level[var] = level
+            self.nDecisions = self.nDecisions+1
+
+            if hooks is not None:
+                hooks.value_tried(self, level, var, val)
+                hooks.propagation_start(self, level, var)
+            status, prunings, blame = self.propagate(propagator, var, val, level)
+            if hooks is not None:
+                hooks.propagation_end(self, level, var, status, prunings)
+            self.nPrunings = self.nPrunings + len(prunings)
+            self.trail.push_all(prunings)
+
+            if not status:
+                frame[4] |= blame & ~(1 << level)
+                self.record_conflict()
+                continue
+
+            if level == nvars:
+                if hooks is not None:
+                    hooks.solution(self, level)
+                yield
+                #search on below a solution chronologically
+                frame[4] |= (1 << level) - 1
+                continue
+            stack.append(self.open_frame(var_ord, val_ord, level+1))
+
+    def open_frame(self, var_ord, val_ord, level):
+        '''A BT decision frame, with the initial conflict set of its
+           variable appended'''
+        frame = BT.open_frame(self, var_ord, val_ord, level)
+        frame.append(self.domain_reason(frame[0]))
+        return frame
+
+    def undo(self, frame, level):
+        '''Internal routine. Undo the value tried by frame, at level'''
+        var, mark = frame[0], frame[3]
+        if self.hooks is not None:
+            self.hooks.backtrack(self, level, var, mark)
+        self.trail.undo_to(mark)
+        var.unassign()
+        del self.level[var]
@@ -0,0 +1,289 @@
+'''Benchmark suite for the propagators and orderings.
+
+   python benchmark.py run [options] [--output FILE]
+       Generate seeded Futoshiki instances (sizes 4..9, several clue and
+       inequality densities) and n-queens instances, solve every instance
+       with every model x propagator x ordering combination, and write
+       one JSON record per run: build and search CPU time, peak memory,
+       decisions, prunings and status.
+
+   python benchmark.py compare BASELINE CURRENT [--threshold T]
+       Compare two outputs of run and report the runs whose search time
+       or memory grew by more than T (a fraction, default 0.25), and the
+       runs whose decision count changed (which means the search itself
+       behaves differently). Exits with status 1 if anything regressed.
+
+   Timings are the minimum over --repeat runs. Memory is measured with
+   tracemalloc in a separate run, as tracing slows the search down.
+   Searches running past --time-limit seconds are abandoned and recorded
+   with status 'timeout' (e.g. model 2 with FC on sparse boards, or plain
+   BT with static ordering). --propagators and --orderings select a
+   subset of the combinations; FC_NUMPY is left out of the default set
+   when numpy is not installed.
+'''
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from cspbase import BT
+from autograder import nQueens
+from futoshiki_parallel import PROPAGATORS, ORDERINGS, MODELS
+
+try:
+    import numpy
+except ImportError:  # only needed by the FC_NUMPY propagator
+    numpy = None
+
+#propagators left out of the default run when numpy is missing
+NEEDS_NUMPY = {'FC_NUMPY'}
+
+
+def random_latin_square(n, rng):
+    '''A random n x n latin square over 1..n: a cyclic square with its
+       rows, columns and symbols shuffled'''
+    rows = list(range(n))
+    cols = list(range(n))
+    symbols = list(range(1, n + 1))
+    rng.shuffle(rows)
+    rng.shuffle(cols)
+    rng.shuffle(symbols)
+    return [[symbols[(r + c) % n] for c in cols] for r in rows]
+
+
+def random_futoshiki(n, clue_density, ineq_density, rng):
+    '''A solvable n x n Futoshiki board (in the futo_grid format of
+       futoshiki_csp) built around a random latin square: each cell is
+       given as a clue with probability clue_density and each pair of
+       horizontally adjacent cells gets its inequality with probability
+       ineq_density. The solution need not be unique'''
+    square = random_latin_square(n, rng)
+    board = []
+    for row in square:
+        line = []
+        for j, val in enumerate(row):
+            if j > 0:
+                if rng.random() < ineq_density:
+                    line.append('<' if row[j-1] < val else '>')
+                else:
+                    line.append('.')
+            line.append(val if rng.random() < clue_density else 0)
+        board.append(line)
+    return board
+
+
+def futoshiki_instances(sizes, densities, boards, seed):
+    '''[(name, n, board)] for every size, (clue, inequality) density pair
+       and board number. Each board has its own seed, so an instance does
+       not change when other sizes or densities are added'''
+    instances = []
+    for n in sizes:
+        for clues, ineqs in densities:
+            for k in range(boards):
+                rng = random.Random('{}-{}-{}-{}-{}'.format(seed, n, clues, ineqs, k))
+                name = 'futoshiki-n{}-c{}-i{}-{}'.format(n, clues, ineqs, k)
+                instances.append((name, n, random_futoshiki(n, clues, ineqs, rng)))
+    return instances
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+def time_limited(propagator, limit):
+    '''Wrap propagator so that it raises TimeLimitExceeded once limit
+       CPU seconds have passed since the wrapper was made'''
+    deadline = time.process_time() + limit
+
+    def limited(csp, newVar=None):
+        if time.process_time() > deadline:
+            raise TimeLimitExceeded()
+        return propagator(csp, newVar)
+    return limited
+
+
+def measure(build, propagator, var_ord, repeat, memory, time_limit):
+    '''Build and solve a CSP, returning the statistics of the run.
+       build() returns a CSP or (csp, var_array)'''
+    best_build = best_search = best_wall = None
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        start = time.process_time()
+        csp = build()
+        build_time = time.process_time() - start
+        if isinstance(csp, tuple):
+            csp = csp[0]
+        solver = BT(csp)
+        try:
+            result = solver.bt_search(time_limited(propagator, time_limit), var_ord)
+        except TimeLimitExceeded:
+            return {'status': 'timeout',
+                    'nDecisions': solver.nDecisions,
+                    'nPrunings': solver.nPrunings,
+                    'build_time': build_time,
+                    'search_time': time_limit,
+                    'wall_time': time.perf_counter() - wall}
+        wall = time.perf_counter() - wall
+        if best_build is None or build_time < best_build:
+            best_build = build_time
+        if best_search is None or result.cpu_time < best_search:
+            best_search = result.cpu_time
+        if best_wall is None or wall < best_wall:
+            best_wall = wall
+
+    record = {'status': result.status,
+              'nDecisions': result.nDecisions,
+              'nPrunings': result.nPrunings,
+              'build_time': best_build,
+              'search_time': best_search,
+              'wall_time': best_wall}
+
+    if memory:
+        tracemalloc.start()
+        csp = build()
+        if isinstance(csp, tuple):
+            csp = csp[0]
+        record['build_memory'] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        try:
+            BT(csp).bt_search(time_limited(propagator, time_limit), var_ord)
+        except TimeLimitExceeded:
+            pass
+        record['search_peak_memory'] = tracemalloc.get_traced_memory()[1] - record['build_memory']
+        tracemalloc.stop()
+    return record
+
+
+def run(args):
+    densities = [tuple(float(x) for x in d.split(',')) for d in args.densities]
+    instances = [(name, n, board, model)
+                 for name, n, board in futoshiki_instances(args.sizes, densities, args.boards, args.seed)
+                 for model in args.models]
+    instances += [('queens-{}'.format(n), n, None, None) for n in args.queens]
+
+    prop_names = args.propagators
+    if prop_names is None:
+        prop_names = [name for name in PROPAGATORS
+                      if numpy is not None or name not in NEEDS_NUMPY]
+    elif numpy is None and NEEDS_NUMPY & set(prop_names):
+        print('error: {} requires numpy, which is not installed'.format(
+            ', '.join(sorted(NEEDS_NUMPY & set(prop_names)))), file=sys.stderr)
+        return 2
+
+    results = []
+    for name, n, board, model in instances:
+        if board is None:
+            build = lambda n=n: nQueens(n)
+        else:
+            build = lambda model=model, board=board: MODELS[model](board)
+        for prop_name in prop_names:
+            for ord_name in args.orderings:
+                record = {'instance': name, 'n': n, 'model': model,
+                          'propagator': prop_name, 'ordering': ord_name}
+                record.update(measure(build, PROPAGATORS[prop_name], ORDERINGS[ord_name],
+                                      args.repeat, not args.no_memory, args.time_limit))
+                results.append(record)
+                if args.verbose:
+                    print('{:32} model {} {:4} {:9} {:8} {:9.4f}s {:8} decisions'.format(
+                        name, model, prop_name, ord_name, record['status'],
+                        record['search_time'], record['nDecisions']), file=sys.stderr)
+
+    output = {'meta': {'seed': args.seed,
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'argv': sys.argv[1:]},
+              'results': results}
+    text = json.dumps(output, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+def run_key(record):
+    return (record['instance'], record['model'], record['propagator'], record['ordering'])
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = {run_key(r): r for r in json.load(f)['results']}
+    with open(args.current) as f:
+        current = {run_key(r): r for r in json.load(f)['results']}
+
+    regressions = []
+    for key in sorted(set(baseline) & set(current), key=str):
+        old = baseline[key]
+        new = current[key]
+        name = '{} model {} {} {}'.format(*key)
+        if old['status'] != new['status']:
+            regressions.append('{}: status {} -> {}'.format(name, old['status'], new['status']))
+        if old['nDecisions'] != new['nDecisions']:
+            regressions.append('{}: decisions {} -> {}'.format(name, old['nDecisions'], new['nDecisions']))
+        for field, floor in (('search_time', args.min_time), ('build_time', args.min_time),
+                             ('search_peak_memory', args.min_memory)):
+            if field not in old or field not in new:
+                continue
+            if new[field] > old[field] * (1 + args.threshold) and new[field] - old[field] > floor:
+                regressions.append('{}: {} {:.4g} -> {:.4g} ({:+.0%})'.format(
+                    name, field, old[field], new[field], new[field] / old[field] - 1 if old[field] else float('inf')))
+
+    for key in sorted(set(baseline) - set(current), key=str):
+        print('missing from current: {} model {} {} {}'.format(*key))
+    for line in regressions:
+        print('REGRESSION', line)
+    common = set(baseline) & set(current)
+    old_total = sum(baseline[k]['search_time'] for k in common)
+    new_total = sum(current[k]['search_time'] for k in common)
+    print('{} runs compared, {} regressions; total search time {:.3f}s -> {:.3f}s'.format(
+        len(common), len(regressions), old_total, new_total))
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the CSP propagators and orderings')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('run', help='run the benchmarks and write JSON results')
+    p.add_argument('--sizes', type=int, nargs='*', default=[4, 5, 6, 7, 8, 9],
+                   help='Futoshiki board sizes')
+    p.add_argument('--densities', nargs='*', default=['0.4,0.3', '0.25,0.5', '0.15,0.15'],
+                   help='Futoshiki CLUES,INEQUALITIES density pairs')
+    p.add_argument('--boards', type=int, default=1, help='boards per size and density')
+    p.add_argument('--queens', type=int, nargs='*', default=[8, 16, 24, 32],
+                   help='n-queens sizes')
+    p.add_argument('--models', type=int, nargs='*', default=[1, 2], choices=sorted(MODELS))
+    p.add_argument('--propagators', nargs='*', choices=sorted(PROPAGATORS),
+                   help='propagators to run (default: all, FC_NUMPY only if numpy is installed)')
+    p.add_argument('--orderings', nargs='*', default=list(ORDERINGS), choices=sorted(ORDERINGS))
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--repeat', type=int, default=1, help='timing runs per combination (minimum kept)')
+    p.add_argument('--time-limit', type=float, default=10.0,
+                   help='CPU seconds allowed per search')
+    p.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    p.add_argument('--output', '-o', help='output file (default stdout)')
+    p.add_argument('--verbose', '-v', action='store_true', help='report progress on stderr')
+    p.set_defaults(func=run)
+
+    p = commands.add_parser('compare', help='flag regressions against a baseline')
+    p.add_argument('baseline')
+    p.add_argument('current')
+    p.add_argument('--threshold', type=float, default=0.25,
+                   help='allowed relative growth of time and memory')
+    p.add_argument('--min-time', type=float, default=0.005,
+                   help='ignore time differences below this many seconds')
+    p.add_argument('--min-memory', type=int, default=64 * 1024,
+                   help='ignore memory differences below this many bytes')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,9 @@
 import time
 import functools
+import itertools
+import weakref
+
+from search_hooks import TraceHooks
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -30,6 +34,10 @@ import functools
       for each variable in the constraint (in the same ORDER as the
       variables of the constraint were specified).
 
+      class PredicateConstraint is a constraint specified instead by a
+      function that tests a tuple of values, so its satisfying tuples
+      never have to be enumerated.
+
     C) Backtracking routine---takes propagator and CSP as arguments
        so that basic backtracking, forward-checking or GAC can be 
        executed depending on the propagator used.
@@ -45,8 +53,9 @@ class Variable:
 
        The variable object offers two types of functionality to support
        search. 
-       (a) It has a current domain, implimented as a set of flags 
-           determining which domain values are "current", i.e., unpruned.
+       (a) It has a current domain, implimented as an integer bitmask
+           whose bits are flags determining which domain values are
+           "current", i.e., unpruned.
            - you can prune a value, and restore it.
            - you can obtain a list of values in the current domain, or count
              how many are still there
@@ -81,16 +90,40 @@ class Variable:
         '''
         self.name = name                #text name for variable
         self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        #map from value to its position in dom so value_index is O(1)
+        self.dom_index = dict()
+        for i, val in enumerate(self.dom):
+            self.dom_index.setdefault(val, i)
+        #current domain is an integer bitmask: bit i is set iff dom[i]
+        #is still in the current domain. cursize caches the number of
+        #set bits so that cur_domain_size is O(1)
+        self.curdom = (1 << len(self.dom)) - 1
+        self.cursize = len(self.dom)
+        #bitmask of the values restore_curdom puts back: all of dom
+        #unless restricted with set_base_domain
+        self.basedom = self.curdom
         #for bt_search
         self.assignedValue = None
+        #(constraint, position in its scope) for every constraint over
+        #this variable, used by assign/unassign to keep the constraints'
+        #counts of unassigned variables up to date
+        self.watchers = []
+        #DomainBuckets this variable reports its domain size to (see
+        #CSP.domain_buckets), and its position there
+        self.buckets = None
+        self.bucket_pos = 0
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
            Removals not supported removals'''
+        oldsize = self.cursize
         for val in values: 
+            self.dom_index.setdefault(val, len(self.dom))
+            self.curdom |= 1 << len(self.dom)
+            self.basedom |= 1 << len(self.dom)
+            self.cursize += 1
             self.dom.append(val)
-            self.curdom.append(True)
+        self.size_changed(oldsize)
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -106,46 +139,114 @@ class Variable:
 
     def prune_value(self, value):
         '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+        bit = 1 << self.value_index(value)
+        if self.curdom & bit:
+            self.curdom ^= bit
+            self.cursize -= 1
+            if self.buckets is not None:
+                self.size_changed(self.cursize + 1)
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        bit = 1 << self.value_index(value)
+        if not self.curdom & bit:
+            self.curdom |= bit
+            self.cursize += 1
+            if self.buckets is not None:
+                self.size_changed(self.cursize - 1)
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
            only assigned value is viewed as being in current domain)'''
-        vals = []
         if self.is_assigned():
-            vals.append(self.get_assigned_value())
-        else:
-            for i, val in enumerate(self.dom):
-                if self.curdom[i]:
-                    vals.append(val)
-        return vals
+            return [self.get_assigned_value()]
+        return [self.dom[i] for i in self.cur_domain_indices()]
+
+    def cur_domain_indices(self):
+        '''Iterate over the domain indices of the values in the CURRENT
+           domain (ignores assignment), lowest index first'''
+        mask = self.curdom
+        while mask:
+            low = mask & -mask
+            yield low.bit_length() - 1
+            mask ^= low
+
+    def cur_domain_mask(self):
+        '''return the CURRENT domain as a bitmask over domain indices (if
+           assigned only the bit of the assigned value is set)'''
+        if self.is_assigned():
+            return 1 << self.value_index(self.get_assigned_value())
+        return self.curdom
+
+    def values_mask(self, values):
+        '''return the bitmask over domain indices of the given values.
+           Values not in the domain are ignored'''
+        mask = 0
+        for val in values:
+            i = self.dom_index.get(val)
+            if i is not None:
+                mask |= 1 << i
+        return mask
+
+    def intersect_cur_domain(self, mask):
+        '''Prune every value of the CURRENT domain whose bit is not set
+           in mask. Returns the list of values pruned'''
+        removed = self.curdom & ~mask
+        if not removed:
+            return []
+        pruned = []
+        while removed:
+            low = removed & -removed
+            pruned.append(self.dom[low.bit_length() - 1])
+            removed ^= low
+        self.curdom &= mask
+        self.cursize -= len(pruned)
+        self.size_changed(self.cursize + len(pruned))
+        return pruned
 
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
+        i = self.dom_index.get(value)
+        if i is None:
             return False
         if self.is_assigned():
             return value == self.get_assigned_value()
         else:
-            return self.curdom[self.value_index(value)]
+            return bool(self.curdom >> i & 1)
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
         if self.is_assigned():
             return 1
         else:
-            return(sum(1 for v in self.curdom if v))
+            return self.cursize
 
     def restore_curdom(self):
-        '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        '''return all values (of the base domain) back into CURRENT domain'''
+        oldsize = self.cursize
+        self.curdom = self.basedom
+        self.cursize = bin(self.basedom).count("1")
+        self.size_changed(oldsize)
+
+    def set_base_domain(self, values=None):
+        '''Restrict the values restore_curdom returns to the CURRENT domain
+           to those of the (permanent) domain that are in values, or to
+           the whole domain if values is None, and reset the CURRENT
+           domain to them. This lets a variable be reused for another
+           problem (e.g. a puzzle clue) without rebuilding it'''
+        if values is None:
+            self.basedom = (1 << len(self.dom)) - 1
+        else:
+            self.basedom = self.values_mask(values)
+        self.restore_curdom()
+
+    def size_changed(self, oldsize):
+        '''Internal routine. Tell the DomainBuckets (if any) that the size
+           of the CURRENT domain went from oldsize to cursize'''
+        if self.buckets is not None and not self.is_assigned():
+            self.buckets.move(self.bucket_pos, oldsize, self.cursize)
 
     #
     #methods for assigning and unassigning
@@ -165,6 +266,11 @@ class Variable:
             return
 
         self.assignedValue = value
+        for c, i in self.watchers:
+            c.n_unasgn -= 1
+            c.unasgn_pos_sum -= i
+        if self.buckets is not None:
+            self.buckets.remove(self.bucket_pos, self.cursize)
 
     def unassign(self):
         '''Used by bt_search. Unassign and restore old curdom'''
@@ -172,6 +278,11 @@ class Variable:
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
         self.assignedValue = None
+        for c, i in self.watchers:
+            c.n_unasgn += 1
+            c.unasgn_pos_sum += i
+        if self.buckets is not None:
+            self.buckets.insert(self.bucket_pos, self.cursize)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
@@ -183,8 +294,12 @@ class Variable:
 
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
-           in the domain list of a variable value'''
-        return self.dom.index(value)
+           in the domain list of a variable value. Raises ValueError
+           if value is not in the domain'''
+        try:
+            return self.dom_index[value]
+        except KeyError:
+            raise ValueError("{} is not in the domain of {}".format(value, self)) from None
 
     def __repr__(self):
         return("Var-{}".format(self.name))
@@ -196,14 +311,79 @@ class Variable:
         '''Also print the variable domain and current domain'''
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             [bool(self.curdom >> i & 1) for i in range(len(self.dom))]))
+class TupleTable:
+    '''The satisfying tuples of a table constraint, indexed by position
+       in the scope rather than by Variable, so that one table can be
+       shared (flyweight) by every constraint over the same relation.
+
+       sat_tuples is a dict whose keys are the tuples, and
+       sup_tuples[(i, val)] is the list of tuples whose i-th value is val.
+
+       TupleTable.intern returns the one table built for a given key, so
+       memory and time spent on tables scale with the number of distinct
+       relations rather than the number of constraints. Interned tables
+       are marked shared and are copied by a constraint before it adds
+       tuples to them.'''
+
+    #key -> interned table, kept while some constraint uses it
+    pool = weakref.WeakValueDictionary()
+
+    def __init__(self, tuples=()):
+        self.sat_tuples = dict()
+        self.sup_tuples = dict()
+        self.shared = False
+        self.add_tuples(tuples)
+
+    @classmethod
+    def intern(cls, key, tuples):
+        '''return the shared table for key (any hashable describing the
+           relation and the domains it is over), building it from tuples
+           (an iterable, or a function returning one) only if it does not
+           exist yet'''
+        table = cls.pool.get(key)
+        if table is None:
+            table = cls(tuples() if callable(tuples) else tuples)
+            table.shared = True
+            cls.pool[key] = table
+        return table
+
+    def add_tuples(self, tuples):
+        '''add satisfying tuples to the table'''
+        for x in tuples:
+            t = tuple(x)  #ensure we have an immutable tuple
+            if t in self.sat_tuples:
+                continue
+            self.sat_tuples[t] = True
+
+            #now put t in as a support for all of the position values in it
+            for i, val in enumerate(t):
+                if not (i, val) in self.sup_tuples:
+                    self.sup_tuples[(i, val)] = []
+                self.sup_tuples[(i, val)].append(t)
+
+    def copy(self):
+        '''return a private (unshared) copy of the table'''
+        table = TupleTable()
+        table.sat_tuples = dict(self.sat_tuples)
+        table.sup_tuples = {k: list(v) for k, v in self.sup_tuples.items()}
+        return table
+
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
        the satisfied function which tests if an assignment to the
        variables in the constraint's scope satisfies the constraint'''
 
-    def __init__(self, name, scope): 
+    #True for constraints defined by their table of satisfying tuples
+    #(sat_tuples). Subclasses defined some other way set it to False.
+    table_based = True
+
+    #True for constraints that forward check themselves (see
+    #BinaryConstraint.forward_check) instead of by checking each value
+    mask_based = False
+
+    def __init__(self, name, scope, table=None): 
         '''create a constraint object, specify the constraint name (a
         string) and its scope (an ORDERED list of variable objects).
         The order of the variables in the scope is critical to the
@@ -217,31 +397,82 @@ class Constraint:
         NOTE: This is a very space expensive representation...a proper
         constraint object would allow for representing the constraint
         with a function.  
+
+        The tuples are kept in a TupleTable. Optionally pass an existing
+        (e.g. interned, see TupleTable.intern) table to share it with
+        other constraints instead of adding tuples to a private one.
         '''
 
         self.scope = list(scope)
         self.name = name
-        self.sat_tuples = dict()
+        self.table = table if table is not None else TupleTable()
+
+        #position of each variable in the scope, to index the table
+        self.var_pos = dict()
+        for i, v in enumerate(self.scope):
+            self.var_pos.setdefault(v, i)
+
+        #number of unassigned variables in the scope and the sum of
+        #their positions, maintained by Variable.assign/unassign. When
+        #one variable is left unassigned, scope[unasgn_pos_sum] is it.
+        self.n_unasgn = 0
+        self.unasgn_pos_sum = 0
+        for i, v in enumerate(self.scope):
+            v.watchers.append((self, i))
+            if not v.is_assigned():
+                self.n_unasgn += 1
+                self.unasgn_pos_sum += i
 
-        #The next object data item 'sup_tuples' will be used to help
-        #support GAC propgation. It allows access to a list of 
-        #satisfying tuples that contain a particular variable/value
-        #pair.
-        self.sup_tuples = dict()
+        #'residues' maps a (var, val) pair to the position in
+        #get_sup_tuples(var, val) of the last support found for it
+        #(AC-2001 style residual support). A residue may be invalid
+        #after pruning, it is only a place to start looking, so it
+        #never needs restoring on backtrack.
+        self.residues = dict()
+
+        #flag set while the constraint is waiting on a GAC queue, so
+        #that queue membership tests are O(1)
+        self.in_queue = False
+
+        #conflict weight for the dom/wdeg heuristic: 1 plus the number of
+        #deadends this constraint has caused (see BT and CSP.conflict)
+        self.weight = 1
+
+        #the sup_tuples view, built on first use and dropped when tuples
+        #are added
+        self.sup_view = None
 
     def add_satisfying_tuples(self, tuples):
         '''We specify the constraint by adding its complete list of satisfying tuples.'''
-        for x in tuples:
-            t = tuple(x)  #ensure we have an immutable tuple
-            if not t in self.sat_tuples:
-                self.sat_tuples[t] = True
-
-            #now put t in as a support for all of the variable values in it
-            for i, val in enumerate(t):
-                var = self.scope[i]
-                if not (var,val) in self.sup_tuples:
-                    self.sup_tuples[(var,val)] = []
-                self.sup_tuples[(var,val)].append(t)
+        if self.table.shared:
+            #never change a table other constraints may be using
+            self.table = self.table.copy()
+        self.table.add_tuples(tuples)
+        self.sup_view = None
+
+    @property
+    def sat_tuples(self):
+        '''dict whose keys are the satisfying tuples'''
+        return self.table.sat_tuples
+
+    @property
+    def sup_tuples(self):
+        '''dict mapping (var, val) to the list of satisfying tuples in
+           which var has value val. Built on first use and kept until
+           tuples are added; the propagators use get_sup_tuples'''
+        if self.sup_view is None:
+            sup = dict()
+            for (i, val), tuples in self.table.sup_tuples.items():
+                sup.setdefault((self.scope[i], val), []).extend(tuples)
+            self.sup_view = sup
+        return self.sup_view
+
+    def get_sup_tuples(self, var, val):
+        '''return the list of satisfying tuples in which var has value val'''
+        i = self.var_pos.get(var)
+        if i is None:
+            return []
+        return self.table.sup_tuples.get((i, val), [])
 
     def get_scope(self):
         '''get list of variables the constraint is over'''
@@ -258,11 +489,19 @@ class Constraint:
 
     def get_n_unasgn(self):
         '''return the number of unassigned variables in the constraint's scope'''
-        n = 0
-        for v in self.scope:
-            if not v.is_assigned():
-                n = n + 1
-        return n
+        return self.n_unasgn
+
+    def detach(self):
+        '''Stop the variables of the scope from updating this constraint's
+           counts of unassigned variables. Call it on a constraint that is
+           discarded while its variables stay in use'''
+        for v in set(self.scope):
+            v.watchers = [(c, i) for c, i in v.watchers if c is not self]
+
+    def get_last_unasgn_var(self):
+        '''return the unassigned variable of the scope when exactly one is
+           left (O(1), see get_n_unasgn)'''
+        return self.scope[self.unasgn_pos_sum]
 
     def get_unasgn_vars(self): 
         '''return list of unassigned variables in constraint's scope. Note
@@ -278,12 +517,28 @@ class Constraint:
            of assignments satisfying the constraint where each value is
            still in the corresponding variables current domain
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
-                if self.tuple_is_valid(t):
-                    return True
+        tuples = self.get_sup_tuples(var, val)
+        if not tuples:
+            return False
+        #check the residual support first, then scan circularly from it
+        start = self.residues.get((var, val), 0)
+        if start >= len(tuples):
+            start = 0
+        for k in itertools.chain(range(start, len(tuples)), range(start)):
+            if self.tuple_is_valid(tuples[k]):
+                self.residues[(var, val)] = k
+                return True
         return False
 
+    def filter(self):
+        '''Constraint specific GAC filtering. A constraint that can make
+           itself GAC more cheaply than by the generic per value support
+           search (see has_support) overrides this to prune the current
+           domains of its scope and return (True/False, [(Variable, Value), ...])
+           like a propagator. The default returns None, which tells the
+           propagator to use the generic support search'''
+        return None
+
     def tuple_is_valid(self, t):
         '''Internal routine. Check if every value in tuple is still in
            corresponding variable domains'''
@@ -295,6 +550,488 @@ class Constraint:
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class PredicateConstraint(Constraint):
+    '''Constraint specified intensionally by a predicate over the values
+       of its scope instead of a table of satisfying tuples. It offers the
+       same check/has_support/get_unasgn_vars interface as Constraint so
+       the propagators can use it unchanged.'''
+
+    table_based = False
+
+    def __init__(self, name, scope, predicate, support=None):
+        '''create a predicate constraint. predicate is a function taking
+        a sequence of values (one per variable, in scope ORDER) and
+        returning True iff they satisfy the constraint.
+
+        support is an optional function support(constraint, var, val)
+        returning a tuple of values satisfying the constraint in which
+        var has value val and every other value is in the current
+        domain of its variable, or None if no such tuple exists. If it
+        is not given, supports are found by enumerating the current
+        domains of the scope, which is only sensible for small scopes.
+        '''
+        Constraint.__init__(self, name, scope)
+        self.predicate = predicate
+        self.support = support
+
+    def check(self, vals):
+        '''return true iff the values satisfy the predicate'''
+        return bool(self.predicate(vals))
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting tuple'''
+        return self.find_support(var, val) is not None
+
+    def find_support(self, var, val):
+        '''return a supporting tuple for var = val, or None'''
+        if not var.in_cur_domain(val):
+            return None
+        #the last support found for (var, val) is often still valid
+        t = self.residues.get((var, val))
+        if t is not None and self.tuple_is_valid(t):
+            return t
+        if self.support is not None:
+            t = self.support(self, var, val)
+        else:
+            t = None
+            domains = [[val] if v is var else v.cur_domain() for v in self.scope]
+            for cand in itertools.product(*domains):
+                if self.predicate(cand):
+                    t = cand
+                    break
+        if t is not None:
+            self.residues[(var, val)] = tuple(t)
+        return t
+
+class BinaryConstraint(Constraint):
+    '''Table constraint over two distinct variables that also keeps,
+       for each domain value of each variable, the bitmask of the
+       supporting values of the other one: supports[0][a] has bit b set
+       iff (x.dom[a], y.dom[b]) is a satisfying tuple, where scope = [x, y],
+       and supports[1][b] has bit a set. Checking the supports of a value
+       is then one AND with the other variable's current domain mask, so
+       forward checking and GAC revisions never look at tuples.
+
+       The masks are computed from the table and the (permanent) domains
+       when the constraint is made, and shared by the constraints over the
+       same interned table and domains. The table is kept as well, so
+       check and the table based propagators work unchanged.'''
+
+    mask_based = True
+
+    #interned table -> {(domain of x, domain of y): supports}
+    shared = weakref.WeakKeyDictionary()
+
+    def __init__(self, name, scope, table=None):
+        if len(scope) != 2 or scope[0] is scope[1]:
+            raise ValueError("a BinaryConstraint needs two distinct variables, got {}".format(scope))
+        Constraint.__init__(self, name, scope, table)
+        self.supports = self.support_masks()
+
+    def add_satisfying_tuples(self, tuples):
+        Constraint.add_satisfying_tuples(self, tuples)
+        self.supports = self.support_masks()
+
+    def support_masks(self):
+        '''Internal routine. (supports of x's values, supports of y's
+           values) for the current table, shared if the table is'''
+        x, y = self.scope
+        by_domains = None
+        if self.table.shared:
+            by_domains = BinaryConstraint.shared.setdefault(self.table, dict())
+            key = (tuple(x.dom), tuple(y.dom))
+            supports = by_domains.get(key)
+            if supports is not None:
+                return supports
+        sup_x = [0] * x.domain_size()
+        sup_y = [0] * y.domain_size()
+        for a, b in self.table.sat_tuples:
+            i = x.dom_index.get(a)
+            j = y.dom_index.get(b)
+            if i is not None and j is not None:
+                sup_x[i] |= 1 << j
+                sup_y[j] |= 1 << i
+        supports = (sup_x, sup_y)
+        if by_domains is not None:
+            by_domains[key] = supports
+        return supports
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting value of the
+           other variable in its current domain'''
+        i = self.var_pos.get(var)
+        if i is None or not var.in_cur_domain(val):
+            return False
+        return bool(self.supports[i][var.dom_index[val]] & self.scope[1 - i].cur_domain_mask())
+
+    def forward_check(self):
+        '''Called with exactly one variable of the scope unassigned:
+           prune its values that are incompatible with the assigned one.
+           Returns the list of values pruned, in domain order'''
+        pos = self.unasgn_pos_sum
+        var = self.scope[pos]
+        other = self.scope[1 - pos]
+        return var.intersect_cur_domain(self.supports[1 - pos][other.dom_index[other.assignedValue]])
+
+    def filter(self):
+        '''Make the constraint arc consistent: revise x against y, then y
+           against what is left of x (after which every value of x still
+           has a support, as supports are symmetric)'''
+        pruned = []
+        x, y = self.scope
+        sup_x, sup_y = self.supports
+        mask_x = x.cur_domain_mask()
+        mask_y = y.cur_domain_mask()
+        keep_x = self.supported(sup_x, mask_x, mask_y)
+        if not keep_x:
+            return False, pruned
+        if keep_x != mask_x:
+            pruned.extend((x, val) for val in x.intersect_cur_domain(keep_x))
+        keep_y = self.supported(sup_y, mask_y, keep_x)
+        if not keep_y:
+            return False, pruned
+        if keep_y != mask_y:
+            pruned.extend((y, val) for val in y.intersect_cur_domain(keep_y))
+        return True, pruned
+
+    @staticmethod
+    def supported(supports, mask, other_mask):
+        '''the bits of mask whose supports meet other_mask'''
+        keep = 0
+        while mask:
+            low = mask & -mask
+            if supports[low.bit_length() - 1] & other_mask:
+                keep |= low
+            mask ^= low
+        return keep
+
+class GreaterThanConstraint(Constraint):
+    '''x > y over scope [x, y], for variables with ordered (e.g.
+       numeric) values, without a table. As the relation is monotone, a
+       value of x has a support iff it is greater than the smallest
+       current value of y, and a value of y iff it is less than the
+       largest current value of x, so revisions only compare values with
+       the bounds of the other domain.'''
+
+    table_based = False
+    mask_based = True
+
+    def __init__(self, name, scope):
+        if len(scope) != 2 or scope[0] is scope[1]:
+            raise ValueError("a GreaterThanConstraint needs two distinct variables, got {}".format(scope))
+        Constraint.__init__(self, name, scope)
+
+    def check(self, vals):
+        '''return true iff the first value is greater than the second'''
+        return vals[0] > vals[1]
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting value of the
+           other variable in its current domain'''
+        if var not in self.var_pos or not var.in_cur_domain(val):
+            return False
+        x, y = self.scope
+        if var is x:
+            return val > min(y.cur_domain())
+        return val < max(x.cur_domain())
+
+    def forward_check(self):
+        '''Called with exactly one variable of the scope unassigned:
+           prune its values that are not on the right side of the
+           assigned one. Returns the list of values pruned, in domain order'''
+        pos = self.unasgn_pos_sum
+        var = self.scope[pos]
+        bound = self.scope[1 - pos].assignedValue
+        return var.intersect_cur_domain(self.bounded(var, var.curdom, bound, pos == 0))
+
+    def filter(self):
+        '''Make the constraint arc consistent: the values of x must be
+           above the minimum of y, then those of y below the maximum of
+           what is left of x'''
+        pruned = []
+        x, y = self.scope
+        mask_x = x.cur_domain_mask()
+        mask_y = y.cur_domain_mask()
+        if not mask_x or not mask_y:
+            return False, pruned
+        keep_x = self.bounded(x, mask_x, min(self.values(y, mask_y)), True)
+        if not keep_x:
+            return False, pruned
+        if keep_x != mask_x:
+            pruned.extend((x, val) for val in x.intersect_cur_domain(keep_x))
+        keep_y = self.bounded(y, mask_y, max(self.values(x, keep_x)), False)
+        if not keep_y:
+            return False, pruned
+        if keep_y != mask_y:
+            pruned.extend((y, val) for val in y.intersect_cur_domain(keep_y))
+        return True, pruned
+
+    @staticmethod
+    def values(var, mask):
+        '''the values of var whose bits are set in mask'''
+        vals = []
+        while mask:
+            low = mask & -mask
+            vals.append(var.dom[low.bit_length() - 1])
+            mask ^= low
+        return vals
+
+    @staticmethod
+    def bounded(var, mask, bound, above):
+        '''the bits of mask whose values are above bound (below it if
+           above is False)'''
+        keep = 0
+        dom = var.dom
+        while mask:
+            low = mask & -mask
+            val = dom[low.bit_length() - 1]
+            if (val > bound) if above else (val < bound):
+                keep |= low
+            mask ^= low
+        return keep
+
+class AllDiffConstraint(Constraint):
+    '''All-different constraint over its scope: no two variables of the
+       scope may take the same value. GAC is enforced in polynomial time
+       by Regin's filtering algorithm (maximum bipartite matching between
+       variables and values, then removal of the edges that belong to no
+       maximum matching), so no tuples are ever enumerated.'''
+
+    table_based = False
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+
+    def check(self, vals):
+        '''return true iff no two of the values are equal'''
+        return len(set(vals)) == len(vals)
+
+    def has_support(self, var, val):
+        '''Test if a variable value pair has a supporting tuple, i.e. the
+           rest of the scope can take distinct values from their current
+           domains'''
+        if not var.in_cur_domain(val):
+            return False
+        domains = [[val] if v is var else v.cur_domain() for v in self.scope]
+        return self.max_matching(domains) is not None
+
+    def filter(self):
+        '''Regin's GAC filter. Prunes every value that appears in no
+           maximum matching of the variable/value graph'''
+        scope = self.scope
+        domains = [v.cur_domain() for v in scope]
+        pruned = []
+
+        #A fixed variable (one value left) would only add an isolated
+        #matched edge to the graph below, which never keeps any other
+        #edge to its value. So remove the values of fixed variables from
+        #the other domains directly (which may fix more variables) and
+        #build the graph over the variables that are still open
+        open_pos = list(range(len(scope)))
+        taken = set()
+        while True:
+            fixed = [x for x in open_pos if len(domains[x]) == 1]
+            if not fixed:
+                break
+            for x in fixed:
+                val = domains[x][0]
+                if val in taken:
+                    return False, pruned
+                taken.add(val)
+            open_pos = [x for x in open_pos if len(domains[x]) != 1]
+            for x in open_pos:
+                d = domains[x]
+                if not taken.isdisjoint(d):
+                    var = scope[x]
+                    for val in d:
+                        if val in taken:
+                            var.prune_value(val)
+                            pruned.append((var, val))
+                    domains[x] = [val for val in d if val not in taken]
+                    if not domains[x]:
+                        return False, pruned
+        if not open_pos:
+            return True, pruned
+        scope = [scope[x] for x in open_pos]
+        domains = [domains[x] for x in open_pos]
+
+        match = self.max_matching(domains)
+        if match is None:
+            return False, pruned
+
+        #Nodes 0..k-1 are variables, values get the following numbers.
+        #Matching edges are directed variable -> value, the other edges
+        #value -> variable.
+        k = len(domains)
+        value_node = dict()
+        for d in domains:
+            for val in d:
+                if val not in value_node:
+                    value_node[val] = k + len(value_node)
+        nnodes = k + len(value_node)
+        succ = [[] for _ in range(nnodes)]
+        matched_values = set()
+        for x, d in enumerate(domains):
+            succ[x].append(value_node[match[x]])
+            matched_values.add(match[x])
+            for val in d:
+                if val != match[x]:
+                    succ[value_node[val]].append(x)
+
+        #An edge is in some maximum matching if it is matched, lies on an
+        #alternating path starting from a free value, or lies on an
+        #alternating cycle (both endpoints in the same SCC)
+        reached = [False] * nnodes
+        stack = [value_node[val] for val in value_node if val not in matched_values]
+        for node in stack:
+            reached[node] = True
+        while stack:
+            node = stack.pop()
+            for nxt in succ[node]:
+                if not reached[nxt]:
+                    reached[nxt] = True
+                    stack.append(nxt)
+        scc = self.scc_ids(succ)
+
+        for x, var in enumerate(scope):
+            for val in domains[x]:
+                node = value_node[val]
+                if val != match[x] and not reached[node] and scc[node] != scc[x]:
+                    var.prune_value(val)
+                    pruned.append((var, val))
+        return True, pruned
+
+    @staticmethod
+    def max_matching(domains):
+        '''Match each position to a distinct value of its domain (a list
+           of lists of values) using augmenting paths. Return the list of
+           matched values, or None if no complete matching exists'''
+        owner = dict()  # value -> position matched to it
+
+        def augment(i, seen):
+            for val in domains[i]:
+                if val not in seen:
+                    seen.add(val)
+                    if val not in owner or augment(owner[val], seen):
+                        owner[val] = i
+                        return True
+            return False
+
+        for i, d in enumerate(domains):
+            #cheap greedy step before looking for an augmenting path
+            for val in d:
+                if val not in owner:
+                    owner[val] = i
+                    break
+            else:
+                if not augment(i, set()):
+                    return None
+        match = [None] * len(domains)
+        for val, i in owner.items():
+            match[i] = val
+        return match
+
+    @staticmethod
+    def scc_ids(succ):
+        '''Tarjan's algorithm (iterative). succ is an adjacency list;
+           return a list giving the strongly connected component id of
+           every node'''
+        n = len(succ)
+        index = [None] * n
+        low = [0] * n
+        comp = [None] * n
+        onstack = [False] * n
+        stack = []
+        counter = 0
+        ncomp = 0
+        for root in range(n):
+            if index[root] is not None:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, i = work.pop()
+                if i == 0:
+                    index[node] = low[node] = counter
+                    counter += 1
+                    stack.append(node)
+                    onstack[node] = True
+                recurse = False
+                edges = succ[node]
+                while i < len(edges):
+                    nxt = edges[i]
+                    i += 1
+                    if index[nxt] is None:
+                        work.append((node, i))
+                        work.append((nxt, 0))
+                        recurse = True
+                        break
+                    elif onstack[nxt]:
+                        low[node] = min(low[node], index[nxt])
+                if recurse:
+                    continue
+                if low[node] == index[node]:
+                    while True:
+                        top = stack.pop()
+                        onstack[top] = False
+                        comp[top] = ncomp
+                        if top == node:
+                            break
+                    ncomp += 1
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+        return comp
+
+class DomainBuckets:
+    '''Index of a list of variables by current domain size, so the
+       unassigned variable with the smallest current domain can be found
+       without scanning every variable. masks[s] is a bitmask over
+       positions in the list of the unassigned variables with exactly s
+       values in their current domain. Variables keep it up to date as
+       they are pruned, unpruned, assigned and unassigned.'''
+
+    def __init__(self, vars):
+        self.vars = list(vars)
+        self.masks = [0]
+        self.low = 0    #no bucket below low is occupied
+        for i, v in enumerate(self.vars):
+            if v.buckets is not None and v.buckets is not self:
+                v.buckets.remove(v.bucket_pos, v.cursize)  # leave old index
+            v.buckets = self
+            v.bucket_pos = i
+            if not v.is_assigned():
+                self.insert(i, v.cursize)
+
+    def insert(self, pos, size):
+        '''add the variable at pos to the bucket for size'''
+        masks = self.masks
+        while len(masks) <= size:
+            masks.append(0)
+        masks[size] |= 1 << pos
+        if size < self.low:
+            self.low = size
+
+    def remove(self, pos, size):
+        '''remove the variable at pos from the bucket for size'''
+        self.masks[size] &= ~(1 << pos)
+
+    def move(self, pos, oldsize, newsize):
+        '''move the variable at pos between buckets'''
+        self.remove(pos, oldsize)
+        self.insert(pos, newsize)
+
+    def min_var(self):
+        '''return the unassigned variable with the smallest current domain
+           (ties go to the variable that comes last), or None'''
+        masks = self.masks
+        s = self.low
+        while s < len(masks) and not masks[s]:
+            s += 1
+        self.low = s
+        if s == len(masks):
+            return None
+        return self.vars[masks[s].bit_length() - 1]
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
@@ -309,6 +1046,16 @@ class CSP:
         self.vars = []
         self.cons = []
         self.vars_to_cons = dict()
+        #propagators set this to the constraint that caused a deadend
+        #when they return False; BT uses it to weight constraints
+        self.conflict = None
+        self.buckets = None
+        #search hooks (see search_hooks.py) the propagators report to
+        self.hooks = None
+        #set when the Variables of this CSP have been reused by a CSP
+        #built after it (see futoshiki_csp.FutoshikiTemplate): their
+        #domains and constraints are no longer this CSP's
+        self.superseded = False
         for v in vars:
             self.add_var(v)
 
@@ -326,7 +1073,7 @@ class CSP:
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
            constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
@@ -336,6 +1083,30 @@ class CSP:
                 self.vars_to_cons[v].append(c)
             self.cons.append(c)
 
+    def remove_constraint(self, c):
+        '''Remove constraint c from the CSP. c keeps watching its
+           variables (so it can be added back); call c.detach() if it is
+           discarded while the variables stay in use'''
+        self.cons.remove(c)
+        for v in c.scope:
+            self.vars_to_cons[v].remove(c)
+
+    def copy(self, name=None):
+        '''return a new CSP over the same Variable and Constraint objects.
+           Constraints added to the copy are not added to this CSP'''
+        csp = CSP(self.name if name is None else name)
+        csp.vars = list(self.vars)
+        csp.cons = list(self.cons)
+        csp.vars_to_cons = {v: list(cs) for v, cs in self.vars_to_cons.items()}
+        return csp
+
+    def check_current(self):
+        '''Raise RuntimeError if the CSP has been superseded, as search
+           would silently use another CSP's domains and constraints'''
+        if self.superseded:
+            raise RuntimeError("CSP {} has been superseded: its variables were reused "
+                               "by a CSP built after it".format(self.name))
+
     def get_all_cons(self):
         '''return list of all constraints in the CSP'''
         return self.cons
@@ -352,6 +1123,15 @@ class CSP:
         '''return list of unassigned variables in the CSP'''
         return [v for v in self.vars if not v.is_assigned()]
 
+    def domain_buckets(self):
+        '''return the DomainBuckets indexing the unassigned variables of
+           the CSP by current domain size, building it on first use. A
+           variable reports to one DomainBuckets at a time, so the index
+           is rebuilt if another CSP over the same variables took them'''
+        if self.buckets is None or (self.vars and self.vars[0].buckets is not self.buckets):
+            self.buckets = DomainBuckets(self.vars)
+        return self.buckets
+
     def print_all(self):
         print("CSP", self.name)
         print("   Variables = ", self.vars)
@@ -364,6 +1144,106 @@ class CSP:
             print(v, " = ", v.get_assigned_value(), "    ", end='')
         print("")
 
+########################################################
+# Trail (undo log for current domains)                 #
+########################################################
+
+class Trail:
+    '''Undo log for the current domains of variables. Every value
+       pruned during search is pushed on the trail. checkpoint() returns
+       a mark, and undo_to(mark) unprunes (most recent first) every value
+       pushed since the mark was taken, so undoing a decision costs
+       O(number of changes) rather than a walk over saved lists'''
+
+    def __init__(self):
+        self.entries = []
+
+    def checkpoint(self):
+        '''return a mark for the current state of the trail'''
+        return len(self.entries)
+
+    def push(self, var, val):
+        '''record that val was pruned from var'''
+        self.entries.append((var, val))
+
+    def push_all(self, prunings):
+        '''record a list of (Variable, Value) prunings'''
+        self.entries.extend(prunings)
+
+    def since(self, mark):
+        '''return the list of prunings recorded after mark'''
+        return self.entries[mark:]
+
+    def undo_to(self, mark):
+        '''unprune every value recorded after mark'''
+        entries = self.entries
+        while len(entries) > mark:
+            var, val = entries.pop()
+            var.unprune_value(val)
+
+    def clear(self):
+        '''forget all recorded prunings (without restoring them)'''
+        self.entries = []
+
+########################################################
+# Search results                                       #
+########################################################
+
+class SolveResult:
+    '''Outcome of one bt_search.
+
+       status       'solved' or 'unsat'
+       assignment   dict {Variable: value} of the solution, None if unsat
+       root_status  False if propagation before any assignment already
+                    detected a deadend
+       cpu_time     process time of the search in seconds
+       wall_time    wall clock time of the search in seconds
+       nDecisions   BT statistics
+       nPrunings
+
+       A SolveResult is true when the CSP was solved'''
+
+    SOLVED = 'solved'
+    UNSAT = 'unsat'
+
+    def __init__(self, csp_name, status, assignment, root_status,
+                 cpu_time, wall_time, nDecisions, nPrunings):
+        self.csp_name = csp_name
+        self.status = status
+        self.assignment = assignment
+        self.root_status = root_status
+        self.cpu_time = cpu_time
+        self.wall_time = wall_time
+        self.nDecisions = nDecisions
+        self.nPrunings = nPrunings
+
+    def __bool__(self):
+        return self.status == SolveResult.SOLVED
+
+    def __repr__(self):
+        return "SolveResult({}, {}, decisions={}, prunings={}, cpu={:.4f}s)".format(
+            self.csp_name, self.status, self.nDecisions, self.nPrunings, self.cpu_time)
+
+    def values(self, var_array):
+        '''Values of a list (or nested lists) of variables in the
+           solution'''
+        return [self.values(item) if isinstance(item, (list, tuple))
+                else self.assignment[item] for item in var_array]
+
+def print_report(solver, result):
+    '''Reporter for bt_search printing the outcome of the search, the
+       solution and the statistics to stdout'''
+    csp = solver.csp
+    if not result.root_status:
+        print("CSP{} detected contradiction at root".format(csp.name))
+    if result:
+        print("CSP {} solved. CPU Time used = {}".format(csp.name, result.cpu_time))
+        csp.print_soln()
+    else:
+        print("CSP{} unsolved. Has no solutions".format(csp.name))
+    print("bt_search finished")
+    solver.print_stats()
+
 ########################################################
 # Backtracking Routine                                 #
 ########################################################
@@ -384,17 +1264,28 @@ class BT:
         self.nDecisions = 0 #nDecisions is the number of variable 
                             #assignments made during search
         self.nPrunings  = 0 #nPrunings is the number of value prunings during search
-        unasgn_vars = list() #used to track unassigned variables
+        self.unasgn_vars = list() #variables unassigned at the start of search
+        self.trail = Trail() #undo log of all prunings made during search
         self.TRACE = False
+        self.hooks = None #search hooks, see search_hooks.py
         self.runtime = 0
 
+    def set_hooks(self, hooks):
+        '''Attach a hooks object (see search_hooks.py) to this solver
+           and its CSP, or detach it with None'''
+        self.hooks = hooks
+        self.csp.hooks = hooks
+
     def trace_on(self):
         '''Turn search trace on'''
         self.TRACE = True
+        self.set_hooks(TraceHooks())
 
     def trace_off(self):
         '''Turn search trace off'''
         self.TRACE = False
+        if isinstance(self.hooks, TraceHooks):
+            self.set_hooks(None)
 
         
     def clear_stats(self):
@@ -413,6 +1304,13 @@ class BT:
         for var, val in prunings:
             var.unprune_value(val)
 
+    def record_conflict(self):
+        '''After a propagator detected a deadend, increase the weight of
+           the constraint it blamed (for dom/wdeg)'''
+        if self.csp.conflict is not None:
+            self.csp.conflict.weight += 1
+            self.csp.conflict = None
+
     def restore_all_variable_domains(self):
         '''Reinitialize all variable domains'''
         if self.csp != None:
@@ -421,11 +1319,7 @@ class BT:
                     var.unassign()
                 var.restore_curdom()
 
-    def restoreUnasgnVar(self, var):
-        '''Add variable back to list of unassigned vars'''
-        self.unasgn_vars.append(var)
-        
-    def bt_search(self,propagator,var_ord=None,val_ord=None):
+    def bt_search(self,propagator,var_ord=None,val_ord=None,reporter=None):
         '''Try to solve the CSP using specified propagator routine
 
            propagator == a function with the following template
@@ -459,100 +1353,220 @@ class BT:
 
            var_ord is the variable ordering function currently being used; 
            val_ord is the value ordering function currently being used.
+
+           Returns a SolveResult; a found solution is also left assigned
+           to the variables. Nothing is printed unless a reporter, a
+           function reporter(solver, result) such as print_report, is
+           given.
            '''
 
         if self.csp is None or propagator is None:
             return
+        self.csp.check_current()
 
         self.clear_stats()
         stime = time.process_time()
+        wtime = time.perf_counter()
 
         self.restore_all_variable_domains()
+        self.trail.clear()
         
         self.unasgn_vars = []
         for v in self.csp.vars:
             if not v.is_assigned():
                 self.unasgn_vars.append(v)
 
+        hooks = self.hooks
+        if hooks is not None:
+            hooks.search_start(self, propagator)
+            hooks.propagation_start(self, 0, None)
+
         status, prunings = propagator(self.csp) #initial propagate no assigned variables.
         
         if prunings is None:
             return
 
-        self.nPrunings = self.nPrunings + len(prunings)
+        if hooks is not None:
+            hooks.propagation_end(self, 0, None, status, prunings)
 
-        if self.TRACE:
-            print(len(self.unasgn_vars), " unassigned variables at start of search")
-            print("Root Prunings: ", prunings)
+        self.nPrunings = self.nPrunings + len(prunings)
+        self.trail.push_all(prunings)
 
+        root_status = status
         if status == False:
-            print("CSP{} detected contradiction at root".format(
-                self.csp.name))
+            self.record_conflict()
         else:
-            status = self.bt_recurse(propagator, var_ord, val_ord, 1)   #now do recursive search
-
-        self.restoreValues(prunings)
-        if status == False:
-            print("CSP{} unsolved. Has no solutions".format(self.csp.name))
-        if status == True:
-            print("CSP {} solved. CPU Time used = {}".format(self.csp.name,
-                                                             time.process_time() - stime))
-            self.csp.print_soln()
-
-        print("bt_search finished")
-        self.print_stats()
+            status = self.bt_iterate(propagator, var_ord, val_ord)   #now do search
 
-    def bt_recurse(self, propagator, var_ord, val_ord, level):
-        '''Return true if found solution. False if still need to search.
-           If top level returns false--> no solution'''
-
-        if self.TRACE:
-            print('  ' * level, "bt_recurse level ", level)
-           
-        if not self.unasgn_vars:
-            #all variables assigned
-            return True
+        self.trail.undo_to(0)
+        self.runtime = time.process_time() - stime
+        if status:
+            assignment = {v: v.get_assigned_value() for v in self.csp.vars}
         else:
-            ##Figure out which variable to assign,
-            ##Then remove it from the list of unassigned vars
-            if var_ord:
-              var = var_ord(self.csp)
-            else:
-              var = self.unasgn_vars[0]
-            self.unasgn_vars.remove(var) 
-
-            if self.TRACE:
-                print('  ' * level, "bt_recurse var = ", var)
+            assignment = None
+        result = SolveResult(self.csp.name,
+                             SolveResult.SOLVED if status else SolveResult.UNSAT,
+                             assignment, root_status, self.runtime,
+                             time.perf_counter() - wtime,
+                             self.nDecisions, self.nPrunings)
+        if hooks is not None:
+            hooks.search_end(self, status)
+        if reporter is not None:
+            reporter(self, result)
+        return result
+
+    def bt_iterate(self, propagator, var_ord, val_ord):
+        '''Return true if found solution. False if no solution below
+           the root. On success the solution is left assigned'''
+        for _ in self.bt_dfs(propagator, var_ord, val_ord):
+            return True
+        return False
 
-            if val_ord:
-              value_order = val_ord(self.csp,var)
+    def bt_solutions(self, propagator, var_ord=None, val_ord=None, var_array=None):
+        '''Generator enumerating all solutions of the CSP. Each solution
+           is yielded as a dict {Variable: value} or, if var_array (a
+           list, or list of lists, of the CSP's variables) is given, as
+           the same shaped list of values. Solutions are produced lazily,
+           so stopping early (break, close()) costs nothing more; the
+           variable domains are restored when the generator finishes or
+           is closed'''
+        for _ in self.bt_search_states(propagator, var_ord, val_ord):
+            if var_array is None:
+                yield {var: var.get_assigned_value() for var in self.csp.vars}
             else:
-              value_order = var.cur_domain()
-
-            for val in value_order:
-
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse trying", var, "=", val)
-
-                var.assign(val)
-                self.nDecisions = self.nDecisions+1
-
-                status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+                yield self.values_of(var_array)
+
+    def bt_count(self, propagator, var_ord=None, val_ord=None, limit=None):
+        '''Return the number of solutions of the CSP, stopping once limit
+           solutions are found (e.g. limit=2 to test that a puzzle has a
+           unique solution). No solution is built'''
+        count = 0
+        states = self.bt_search_states(propagator, var_ord, val_ord)
+        try:
+            for _ in states:
+                count += 1
+                if limit is not None and count >= limit:
+                    break
+        finally:
+            states.close()
+        return count
+
+    def values_of(self, var_array):
+        '''Values assigned to a list (or nested lists) of variables'''
+        return [self.values_of(item) if isinstance(item, (list, tuple))
+                else item.get_assigned_value() for item in var_array]
+
+    def bt_search_states(self, propagator, var_ord=None, val_ord=None):
+        '''Generator doing the root propagation and then yielding (None)
+           each time all variables are assigned consistently. The
+           solution can be read off the variables before resuming. On
+           exit all domains and assignments are restored'''
+        self.csp.check_current()
+        self.clear_stats()
+        self.restore_all_variable_domains()
+        self.trail.clear()
+        self.unasgn_vars = [v for v in self.csp.vars if not v.is_assigned()]
+        hooks = self.hooks
+        found = False
+        try:
+            if hooks is not None:
+                hooks.search_start(self, propagator)
+                hooks.propagation_start(self, 0, None)
+            status, prunings = propagator(self.csp)
+            if hooks is not None:
+                hooks.propagation_end(self, 0, None, status, prunings)
+            self.nPrunings = self.nPrunings + len(prunings)
+            self.trail.push_all(prunings)
+            if status:
+                for _ in self.bt_dfs(propagator, var_ord, val_ord):
+                    found = True
+                    yield
+            else:
+                self.record_conflict()
+        finally:
+            self.trail.undo_to(0)
+            self.restore_all_variable_domains()
+            if hooks is not None:
+                hooks.search_end(self, found)
+
+    def bt_dfs(self, propagator, var_ord, val_ord):
+        '''Depth first search driven by an explicit stack rather than
+           recursion, so the depth of search is not limited by the
+           Python recursion limit. Each stack entry is a decision frame
+           [var, value_order, next position in value_order, trail mark].
+           Generator: yields (None) at each solution, with the solution
+           assigned; resuming it backtracks and searches for the next'''
+
+        hooks = self.hooks
+        nvars = len(self.unasgn_vars)
+        if nvars == 0:
+            #all variables assigned
+            if hooks is not None:
+                hooks.solution(self, 0)
+            yield
+            return
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
+        stack = [self.open_frame(var_ord, val_ord, 1)]
+        while stack:
+            level = len(stack)
+            frame = stack[-1]
+            var, value_order, pos, mark = frame
+
+            if var.is_assigned():
+                #undo the value tried last time at this level
+                if hooks is not None:
+                    hooks.backtrack(self, level, var, mark)
+                self.trail.undo_to(mark)
+                var.unassign()
 
-                if status:
-                    if self.bt_recurse(propagator, var_ord,val_ord, level+1):
-                        return True
+            if pos == len(value_order):
+                #values exhausted, backtrack to previous level
+                stack.pop()
+                continue
+
+            val = value_order[pos]
+            frame[2] = pos + 1
+
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
+
+            if hooks is not None:
+                hooks.value_tried(self, level, var, val)
+                hooks.propagation_start(self, level, var)
+            status, prunings = propagator(self.csp, var)
+            if hooks is not None:
+                hooks.propagation_end(self, level, var, status, prunings)
+            self.nPrunings = self.nPrunings + len(prunings)
+            self.trail.push_all(prunings)
+            if not status:
+                self.record_conflict()
+
+            if status:
+                if level == nvars:
+                    if hooks is not None:
+                        hooks.solution(self, level)
+                    yield
+                    continue
+                stack.append(self.open_frame(var_ord, val_ord, level+1))
+
+    def open_frame(self, var_ord, val_ord, level):
+        '''Pick the variable to assign at level (1 is the first decision)
+           and return a new decision frame for it'''
+
+        ##Figure out which variable to assign. Without a variable
+        ##ordering, variables are assigned in the order they had
+        ##in the CSP when search started
+        if var_ord:
+          var = var_ord(self.csp)
+        else:
+          var = self.unasgn_vars[level-1]
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
-                var.unassign()
+        if self.hooks is not None:
+            self.hooks.node(self, level, var)
 
-            self.restoreUnasgnVar(var)
-            return False
+        if val_ord:
+          value_order = val_ord(self.csp,var)
+        else:
+          value_order = var.cur_domain()
 
+        return [var, value_order, 0, self.trail.checkpoint()]
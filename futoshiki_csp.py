@@ -21,26 +21,83 @@ cell of the Futoshiki puzzle.
     - A model of a Futoshiki grid built using only n-ary 
       all-different constraints for both the row and column constraints. 
 
+3. futoshiki_csp_from_template
+    - Builds model 1 or 2 for a board from a template compiled once per
+      board size (see FutoshikiTemplate), for solving many boards of the
+      same size.
+
+All of them restrict the domains of the cells to the bounds implied by the
+chains of inequalities of the board (see inequality_bounds) before search.
+
 '''
 from cspbase import *
+import functools
 import itertools
+import operator
+import weakref
 
 
-from cspbase import *
+def relation_table(op, var1, var2):
+    '''return the shared TupleTable of the pairs (x, y) of current domain
+       values of var1 and var2 with op(x, y) true. Constraints over the
+       same relation and domains all get the same table'''
+    dom1 = tuple(var1.cur_domain())
+    dom2 = tuple(var2.cur_domain())
+    return TupleTable.intern((op, dom1, dom2), lambda: [(x, y) for x, y in itertools.product(dom1, dom2) if op(x, y)])
+
+
+def inequality_bounds(futo_grid):
+    '''Bounds on the cell values implied by the clues and chains of
+       inequalities of the board. Returns (low, high), two lists indexed
+       by cell (row by row). A cell greater than a chain of k cells is at
+       least k+1, or more if the chain reaches a clue, and likewise for
+       upper bounds.
+
+       Inequalities only join horizontal neighbours, so the chains into a
+       cell come from its left or from its right along the row: one
+       sweep in each direction per row finds the longest ones. If a
+       bound crosses the other (e.g. a chain longer than the row allows)
+       the board has no solution, and the cell gets low > high.'''
+    size = len(futo_grid)
+    low = []
+    high = []
+    for row in futo_grid:
+        cells = row[0::2]
+        signs = row[1::2]
+        lo = [elem if elem else 1 for elem in cells]
+        hi = [elem if elem else size for elem in cells]
+        #left to right, then right to left: k is the neighbour of j
+        #already swept, whose bounds include every chain through it
+        for step in (1, -1):
+            for j in (range(1, size) if step == 1 else range(size - 2, -1, -1)):
+                k = j - step
+                sign = signs[min(j, k)]
+                if sign == '.':
+                    continue
+                if (sign == '<') == (k < j):
+                    lo[j] = max(lo[j], lo[k] + 1)
+                else:
+                    hi[j] = min(hi[j], hi[k] - 1)
+        low.extend(lo)
+        high.extend(hi)
+    return low, high
 
 
 def futoshiki_csp_model_1(futo_grid):
     size = len(futo_grid)
     domain = list(range(1, size + 1))
 
+    low, high = inequality_bounds(futo_grid)
     X = []
     for i, row in enumerate(futo_grid):
         for j, elem in enumerate(row):
             if isinstance(elem, int):
                 if elem:
-                    variable = Variable(f"({i},{j//2})", [elem])
+                    values = [elem]
                 else:
-                    variable = Variable(f"({i},{j//2})", domain)
+                    values = domain
+                k = len(X)
+                variable = Variable(f"({i},{j//2})", [v for v in values if low[k] <= v <= high[k]])
                 X.append(variable)
 
     # Equality Constraints
@@ -52,16 +109,14 @@ def futoshiki_csp_model_1(futo_grid):
             for col in range(size):
                 if col != j:
                     var2 = X[i * size + col]
-                    constraint = Constraint(f"({var1} != {var2})", [var1, var2])
-                    constraint.add_satisfying_tuples([(x, y) for x, y in itertools.product(var1.cur_domain(), var2.cur_domain()) if x != y])
+                    constraint = BinaryConstraint(f"({var1} != {var2})", [var1, var2], relation_table(operator.ne, var1, var2))
                     constraint_list.append(constraint)
 
             # Column
             for row in range(size):
                 if row != i:
                     var2 = X[row * size + j]
-                    constraint = Constraint(f"({var1} != {var2})", [var1, var2])
-                    constraint.add_satisfying_tuples([(x, y) for x, y in itertools.product(var1.cur_domain(), var2.cur_domain()) if x != y])
+                    constraint = BinaryConstraint(f"({var1} != {var2})", [var1, var2], relation_table(operator.ne, var1, var2))
                     constraint_list.append(constraint)
 
     # Inequality constraints
@@ -75,8 +130,7 @@ def futoshiki_csp_model_1(futo_grid):
                 continue
             var1 = X[(i * size) + left // 2]
             var2 = X[(i * size) + right // 2]
-            constraint = Constraint(f"({var1} > {var2})", [var1, var2])
-            constraint.add_satisfying_tuples([(x, y) for x, y in itertools.product(var1.cur_domain(), var2.cur_domain()) if x > y])
+            constraint = GreaterThanConstraint(f"({var1} > {var2})", [var1, var2])
             constraint_list.append(constraint)
 
     X_matrix = [[X[i * size + j] for j in range(size)] for i in range(size)]
@@ -91,14 +145,17 @@ def futoshiki_csp_model_2(futo_grid):
     size = len(futo_grid)
     domain = list(range(1, size + 1))
 
+    low, high = inequality_bounds(futo_grid)
     X = []
     for i, row in enumerate(futo_grid):
         for j, elem in enumerate(row):
             if isinstance(elem, int):
                 if elem:
-                    variable = Variable(f"({i},{j//2})", [elem])
+                    values = [elem]
                 else:
-                    variable = Variable(f"({i},{j//2})", domain)
+                    values = domain
+                k = len(X)
+                variable = Variable(f"({i},{j//2})", [v for v in values if low[k] <= v <= high[k]])
                 X.append(variable)
 
     # N-ary
@@ -110,8 +167,7 @@ def futoshiki_csp_model_2(futo_grid):
         row_vars = []
         for j in range(size):
             row_vars.append(X[i * size + j])
-        constraint_row = Constraint(f"diffRow{i}", row_vars)
-        constraint_row.add_satisfying_tuples(itertools.permutations(domain, size))
+        constraint_row = AllDiffConstraint(f"diffRow{i}", row_vars)
         row_constraint_list.append(constraint_row)
 
     # Column
@@ -119,8 +175,7 @@ def futoshiki_csp_model_2(futo_grid):
         col_vars = []
         for i in range(size):
             col_vars.append(X[i * size + j])
-        constraint_col = Constraint(f"diffCol{j}", col_vars)
-        constraint_col.add_satisfying_tuples(itertools.permutations(domain, size))
+        constraint_col = AllDiffConstraint(f"diffCol{j}", col_vars)
         col_constraint_list.append(constraint_col)
 
     # Inequality constraints
@@ -135,9 +190,7 @@ def futoshiki_csp_model_2(futo_grid):
                 continue
             var1 = X[(i * size) + left // 2]
             var2 = X[(i * size) + right // 2]
-            constraint = Constraint("Inequality{}".format(len(inequality_constraint_list) + 1), [var1, var2])
-            constraint.add_satisfying_tuples(
-                [(x, y) for x, y in itertools.product(var1.cur_domain(), var2.cur_domain()) if x > y])
+            constraint = GreaterThanConstraint("Inequality{}".format(len(inequality_constraint_list) + 1), [var1, var2])
             inequality_constraint_list.append(constraint)
 
     all_constraints = row_constraint_list + col_constraint_list + inequality_constraint_list
@@ -149,4 +202,136 @@ def futoshiki_csp_model_2(futo_grid):
 
     X_matrix = [[X[i * size + j] for j in range(size)] for i in range(size)]
 
-    return csp, X_matrix
\ No newline at end of file
+    return csp, X_matrix
+
+
+class FutoshikiTemplate:
+    '''A size-n Futoshiki model (model 1 or 2) compiled once and reused for
+       every board of that size. The constructor builds the Variables and
+       the row/column constraints (sharing their tables); instantiate only
+       applies a board's clues and inequality bounds (see
+       inequality_bounds), by restricting the base domains of the cells,
+       and its inequalities, as new GreaterThanConstraints.
+
+       The Variables belong to the template: the (csp, var_array) returned
+       by instantiate is valid until the next board is instantiated from
+       the same template, which marks the earlier CSP superseded (searching
+       it then raises RuntimeError, see CSP.check_current).
+
+       Unlike futoshiki_csp_model_1/2, every cell keeps the permanent
+       domain 1..n (Variable.domain()), clue cells included: the clues and
+       bounds restrict the base domain, so they show in cur_domain().'''
+
+    def __init__(self, size, model=1):
+        if model not in (1, 2):
+            raise ValueError("unknown Futoshiki model {}".format(model))
+        self.size = size
+        self.model = model
+        domain = list(range(1, size + 1))
+        self.domain = domain
+
+        X = []
+        for i in range(size):
+            for j in range(size):
+                X.append(Variable(f"({i},{j})", domain))
+        self.vars = X
+        self.csp = CSP(f"Futoshiki_Model_{model}", X)
+
+        if model == 1:
+            ne = relation_table(operator.ne, X[0], X[0])
+            for i in range(size):
+                for j in range(size):
+                    var1 = X[i * size + j]
+                    # Row
+                    for col in range(size):
+                        if col != j:
+                            var2 = X[i * size + col]
+                            self.csp.add_constraint(BinaryConstraint(f"({var1} != {var2})", [var1, var2], ne))
+                    # Column
+                    for row in range(size):
+                        if row != i:
+                            var2 = X[row * size + j]
+                            self.csp.add_constraint(BinaryConstraint(f"({var1} != {var2})", [var1, var2], ne))
+        else:
+            for i in range(size):
+                self.csp.add_constraint(AllDiffConstraint(f"diffRow{i}", X[i * size:(i + 1) * size]))
+            for j in range(size):
+                self.csp.add_constraint(AllDiffConstraint(f"diffCol{j}", X[j::size]))
+
+        self.inequalities = []  # inequality constraints of the current board
+        self.current = None  # weak reference to the CSP of the current board
+
+    def instantiate(self, futo_grid):
+        '''Set the template up for futo_grid and return (csp, var_array)
+           as futoshiki_csp_model_1/2 would'''
+        size = self.size
+        if len(futo_grid) != size:
+            raise ValueError("board of size {} given to a size {} template".format(len(futo_grid), size))
+        X = self.vars
+
+        previous = self.current() if self.current is not None else None
+        if previous is not None:
+            previous.superseded = True
+        for c in self.inequalities:
+            c.detach()
+        self.inequalities = []
+        for v in X:
+            if v.is_assigned():
+                v.unassign()
+        for c in self.csp.cons:
+            c.weight = 1
+
+        # Clues, and the bounds from the chains of inequalities
+        low, high = inequality_bounds(futo_grid)
+        for i, row in enumerate(futo_grid):
+            for j, elem in enumerate(row):
+                if isinstance(elem, int):
+                    k = i * size + j // 2
+                    values = [elem] if elem else self.domain
+                    X[k].set_base_domain([v for v in values if low[k] <= v <= high[k]])
+
+        # Inequality constraints
+        csp = self.csp.copy()
+        for i, row in enumerate(futo_grid):
+            for j, elem in enumerate(row):
+                if elem == ">":
+                    left, right = j - 1, j + 1
+                elif elem == "<":
+                    left, right = j + 1, j - 1
+                else:
+                    continue
+                var1 = X[(i * size) + left // 2]
+                var2 = X[(i * size) + right // 2]
+                if self.model == 1:
+                    name = f"({var1} > {var2})"
+                else:
+                    name = "Inequality{}".format(len(self.inequalities) + 1)
+                constraint = GreaterThanConstraint(name, [var1, var2])
+                self.inequalities.append(constraint)
+                csp.add_constraint(constraint)
+
+        self.current = weakref.ref(csp)
+        X_matrix = [[X[i * size + j] for j in range(size)] for i in range(size)]
+        return csp, X_matrix
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_template(size, model):
+    return FutoshikiTemplate(size, model)
+
+
+def futoshiki_template(size, model=1):
+    '''return the FutoshikiTemplate for boards of the given size and model,
+       compiling it on first use. Templates are kept in a bounded cache
+       that evicts the least recently used one'''
+    return _cached_template(size, model)
+
+
+def futoshiki_csp_from_template(futo_grid, model=1):
+    '''Build the CSP for futo_grid from the cached template of its size.
+       Returns (csp, var_array) like futoshiki_csp_model_1/2, except that
+       clue cells keep the permanent domain 1..n (see FutoshikiTemplate).
+       The Variables are reused by the next board of the same size and
+       model built this way, after which searching csp raises
+       RuntimeError'''
+    return futoshiki_template(len(futo_grid), model).instantiate(futo_grid)
\ No newline at end of file
@@ -0,0 +1,220 @@
+'''Streaming input and output of Futoshiki boards and results.
+
+   Boards can be read from two line based formats, one board per line:
+
+   JSONL   each line is a JSON board in the futo_grid format of
+           futoshiki_csp, e.g. [[1, "<", 0, ".", 0], ...], or an object
+           {"id": ..., "board": [[...], ...]}
+
+   text    the compact encoding of format_board: the rows separated by
+           '/', each row its cell values (0 for empty) separated by '<',
+           '>' or '.', e.g. 1<0.0/0.0.2/2.0>0 . The board may be preceded
+           by an id and whitespace. Blank lines and lines starting with
+           '#' are skipped.
+
+   Files ending in .gz are read and written compressed.
+
+   read_boards yields (id, board) pairs as it reads, so memory use does
+   not depend on the size of the file. Boards are validated strictly
+   (shape, cell values, inequality symbols); an invalid board raises
+   ValueError naming the file and line. Boards without an id get their
+   line number.
+
+   ResultWriter writes one JSON object per line. solve_file joins the two
+   with futoshiki_parallel.solve_boards into a constant memory pipeline:
+
+       python futoshiki_io.py boards.txt results.jsonl --processes 8
+'''
+import argparse
+import gzip
+import json
+import re
+import sys
+
+from futoshiki_parallel import solve_boards, PROPAGATORS, ORDERINGS, MODELS
+
+
+INEQUALITIES = ('<', '>', '.')
+
+
+def open_file(path, mode):
+    '''open a text file, through gzip if its name ends in .gz. '-' is
+       stdin or stdout'''
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def validate_board(board):
+    '''Check that board is a well formed futo_grid (a list of n rows, each
+       n cell values in 0..n interleaved with n-1 of '<', '>', '.').
+       Raise ValueError otherwise; return the board'''
+    if not isinstance(board, list) or not board:
+        raise ValueError("a board must be a non empty list of rows")
+    size = len(board)
+    for i, row in enumerate(board):
+        if not isinstance(row, list) or len(row) != 2 * size - 1:
+            raise ValueError("row {} of a size {} board must have {} entries".format(
+                i, size, 2 * size - 1))
+        for k, elem in enumerate(row):
+            if k % 2 == 0:
+                if type(elem) is not int or not 0 <= elem <= size:
+                    raise ValueError("row {} cell {}: {!r} is not a value in 0..{}".format(
+                        i, k // 2, elem, size))
+            elif elem not in INEQUALITIES:
+                raise ValueError("row {} position {}: {!r} is not one of < > .".format(i, k, elem))
+    return board
+
+
+_separators = re.compile(r'([<>.])')
+
+def parse_board(text):
+    '''Parse the compact text encoding of a board (see format_board)'''
+    board = []
+    for row_text in text.split('/'):
+        row = []
+        for k, token in enumerate(_separators.split(row_text)):
+            if k % 2 == 0:
+                if not token.isdigit() or not token.isascii():
+                    raise ValueError("{!r} is not a cell value".format(token))
+                row.append(int(token))
+            else:
+                row.append(token)
+        board.append(row)
+    return validate_board(board)
+
+
+def format_board(board):
+    '''The compact text encoding of a board: rows separated by '/', cells
+       separated by their inequality symbol or '.' '''
+    return '/'.join(''.join(str(elem) for elem in row) for row in board)
+
+
+def parse_jsonl_line(line):
+    '''(id or None, board) from a JSONL line'''
+    record = json.loads(line)
+    board_id = None
+    if isinstance(record, dict):
+        if 'board' not in record:
+            raise ValueError("object without a 'board'")
+        board_id = record.get('id')
+        record = record['board']
+    return board_id, validate_board(record)
+
+
+def parse_text_line(line):
+    '''(id or None, board) from a line of the text format'''
+    fields = line.split()
+    if len(fields) == 1:
+        return None, parse_board(fields[0])
+    if len(fields) == 2:
+        return fields[0], parse_board(fields[1])
+    raise ValueError("expected a board, optionally preceded by an id")
+
+
+def guess_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    return 'jsonl' if name.endswith(('.jsonl', '.json')) else 'text'
+
+
+def read_boards(path, fmt=None):
+    '''Generator of the (id, board) pairs of the file path, in the given
+       format ('jsonl' or 'text'; by default 'jsonl' for .jsonl/.json
+       files and 'text' otherwise)'''
+    if fmt is None:
+        fmt = guess_format(path)
+    if fmt == 'jsonl':
+        parse = parse_jsonl_line
+    elif fmt == 'text':
+        parse = parse_text_line
+    else:
+        raise ValueError("unknown board format {!r}".format(fmt))
+
+    f = open_file(path, 'r')
+    try:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or (fmt == 'text' and line.startswith('#')):
+                continue
+            try:
+                board_id, board = parse(line)
+            except ValueError as e:
+                raise ValueError("{}:{}: {}".format(path, lineno, e)) from None
+            yield (lineno if board_id is None else board_id), board
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class ResultWriter:
+    '''Write result records (dicts) to path as JSON lines. Use as a
+       context manager, or call close()'''
+
+    def __init__(self, path):
+        self.file = open_file(path, 'w')
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':')))
+        self.file.write('\n')
+        self.count += 1
+
+    def write_result(self, board_id, result):
+        '''Write a result dict of futoshiki_parallel.solve_board under the
+           id of its board'''
+        record = {'id': board_id, 'status': 'solved' if result['solution'] else 'unsat'}
+        record.update((k, v) for k, v in result.items() if k != 'index')
+        self.write(record)
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def solve_file(in_path, out_path, fmt=None, **options):
+    '''Solve every board of in_path (see read_boards) and write the
+       results to out_path, in the order they finish. options are passed
+       to solve_boards. Only the boards being solved are held in memory.
+       Returns the number of boards solved'''
+    ids = {}  # index -> id of the boards handed to solve_boards and not yet written
+
+    def boards():
+        for index, (board_id, board) in enumerate(read_boards(in_path, fmt)):
+            ids[index] = board_id
+            yield board
+
+    with ResultWriter(out_path) as writer:
+        for result in solve_boards(boards(), **options):
+            writer.write_result(ids.pop(result['index']), result)
+        return writer.count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Solve a file of Futoshiki boards')
+    parser.add_argument('input', help="board file (.jsonl or text, optionally .gz; '-' for stdin)")
+    parser.add_argument('output', help="JSONL result file ('-' for stdout)")
+    parser.add_argument('--format', choices=['jsonl', 'text'], help='input format')
+    parser.add_argument('--propagator', default='GAC', choices=sorted(PROPAGATORS))
+    parser.add_argument('--ordering', default='mrv', choices=sorted(ORDERINGS))
+    parser.add_argument('--model', type=int, default=1, choices=sorted(MODELS))
+    parser.add_argument('--processes', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunksize', type=int, default=16)
+    args = parser.parse_args(argv)
+    solve_file(args.input, args.output, args.format, propagator=args.propagator,
+               var_ord=args.ordering, model=args.model, processes=args.processes,
+               chunksize=args.chunksize)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+'''Solving many Futoshiki boards using several processes.
+
+   solve_boards(boards, ...) takes an iterable of boards (in the futo_grid
+   format used by futoshiki_csp) and distributes them, in chunks, over a
+   multiprocessing pool. It is a generator: it yields one result per board
+   as soon as the chunk holding that board is solved, so results arrive
+   out of order and are tagged with the index of their board in the input.
+
+   Boards are read from the iterable only as workers free up (at most
+   max_pending chunks are in flight), so the input can be a stream far
+   larger than memory.
+
+   A result is a dict with the keys
+      'index'        position of the board in the input
+      'solution'     list of lists of cell values, or None if unsolvable
+      'build_time'   CPU seconds spent building the CSP
+      'search_time'  CPU seconds spent in bt_search
+      'time'         wall clock seconds for the whole board
+      'nDecisions'   BT statistics
+      'nPrunings'
+
+   The propagator and the variable ordering are given either as functions
+   from propagators.py or by name (see PROPAGATORS and ORDERINGS).
+
+   solve_portfolio(board, ...) instead races several configurations
+   (model, propagator, ordering) on one board, each in its own process,
+   returns the first result and kills the others. The result records
+   which configuration won, so defaults can be tuned from real traffic.
+'''
+import itertools
+import multiprocessing
+import os
+import pickle
+import queue
+import time
+
+from cspbase import BT
+from propagators import *
+from futoshiki_csp import *
+
+
+PROPAGATORS = {'BT': prop_BT, 'FC': prop_FC, 'GAC': prop_GAC, 'CT': prop_CT,
+               'FC_NUMPY': prop_FC_numpy}
+ORDERINGS = {'static': None, 'mrv': ord_mrv, 'dom_wdeg': ord_dom_wdeg, 'dom_ddeg': ord_dom_ddeg}
+MODELS = {1: futoshiki_csp_model_1, 2: futoshiki_csp_model_2}
+
+#configurations raced by solve_portfolio: name -> (model, propagator, var_ord)
+DEFAULT_PORTFOLIO = {
+    'model1-GAC-mrv': (1, 'GAC', 'mrv'),
+    'model2-GAC-mrv': (2, 'GAC', 'mrv'),
+    'model1-FC-mrv': (1, 'FC', 'mrv'),
+    'model1-CT-dom_wdeg': (1, 'CT', 'dom_wdeg'),
+}
+
+
+def solve_board(board, propagator=prop_GAC, var_ord=ord_mrv, model=1, use_template=True):
+    '''Solve one board and return its result dict (without 'index').
+       With use_template the CSP is built from the cached per-size
+       template (see futoshiki_csp_from_template)'''
+    if isinstance(propagator, str):
+        propagator = PROPAGATORS[propagator]
+    if isinstance(var_ord, str):
+        var_ord = ORDERINGS[var_ord]
+
+    wall = time.perf_counter()
+    start = time.process_time()
+    if use_template:
+        csp, var_array = futoshiki_csp_from_template(board, model)
+    else:
+        csp, var_array = MODELS[model](board)
+    build_time = time.process_time() - start
+
+    solver = BT(csp)
+    result = solver.bt_search(propagator, var_ord)
+
+    return {'solution': result.values(var_array) if result else None,
+            'build_time': build_time,
+            'search_time': result.cpu_time,
+            'time': time.perf_counter() - wall,
+            'nDecisions': result.nDecisions,
+            'nPrunings': result.nPrunings}
+
+
+def solve_chunk(chunk, config):
+    '''Worker routine: solve a list of (index, board) pairs'''
+    results = []
+    for index, board in chunk:
+        result = solve_board(board, *config)
+        result['index'] = index
+        results.append(result)
+    return results
+
+
+def solve_boards(boards, propagator='GAC', var_ord='mrv', model=1, processes=None,
+                 chunksize=16, max_pending=None, use_template=True):
+    '''Solve an iterable of boards over a pool of processes (os.cpu_count()
+       by default), chunksize boards per task, yielding result dicts as
+       they finish. At most max_pending chunks (default: 2 per process)
+       are queued at any time. With processes=1 the boards are solved in
+       this process, in order'''
+    config = (propagator, var_ord, model, use_template)
+    numbered = enumerate(boards)
+    chunks = iter(lambda: list(itertools.islice(numbered, chunksize)), [])
+
+    if processes == 1:
+        for chunk in chunks:
+            yield from solve_chunk(chunk, config)
+        return
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * processes
+
+    done = queue.Queue()
+    with multiprocessing.Pool(processes) as pool:
+        pending = 0
+        for chunk in chunks:
+            pool.apply_async(solve_chunk, (chunk, config),
+                             callback=done.put, error_callback=done.put)
+            pending += 1
+            while pending >= max_pending:
+                pending -= 1
+                yield from finished(done.get())
+        while pending:
+            pending -= 1
+            yield from finished(done.get())
+
+
+def finished(results):
+    '''Internal routine. Unpack what a worker returned, re-raising its
+       exception if it failed'''
+    if isinstance(results, BaseException):
+        raise results
+    return results
+
+
+def portfolio_worker(name, board, config, results):
+    '''Worker routine of solve_portfolio: solve board with one
+       configuration and put (name, result or exception) on results'''
+    model, propagator, var_ord = config
+    try:
+        result = solve_board(board, propagator, var_ord, model)
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            #the queue would fail to send it, and the race would wait on
+            #this worker until it is seen to have exited
+            e = RuntimeError("{}: {}".format(type(e).__name__, e))
+        results.put((name, e))
+    else:
+        results.put((name, result))
+
+
+#seconds between checks that the portfolio workers are still alive
+POLL_INTERVAL = 0.1
+
+
+def solve_portfolio(board, portfolio=None, timeout=None, wins=None):
+    '''Solve board with every configuration of portfolio (a dict
+       name -> (model, propagator, var_ord), DEFAULT_PORTFOLIO by default)
+       in parallel processes. Return the result dict of the first to
+       finish, with 'config' set to its name and 'portfolio_time' to the
+       wall clock time of the race; the other processes are terminated.
+       Return None if no configuration finished within timeout seconds.
+       If no configuration succeeds, the exception of the last one to
+       fail is raised, or RuntimeError if every process died without
+       reporting (e.g. killed). If wins (a dict, e.g. collections.Counter) is given,
+       the count of the winning configuration is incremented in it'''
+    if portfolio is None:
+        portfolio = DEFAULT_PORTFOLIO
+    if not portfolio:
+        raise ValueError("solve_portfolio needs at least one configuration")
+    start = time.perf_counter()
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=portfolio_worker,
+                                     args=(name, board, config, results),
+                                     daemon=True)
+             for name, config in portfolio.items()]
+    for p in procs:
+        p.start()
+    try:
+        failures = 0
+        error = None
+        while True:
+            wait = POLL_INTERVAL
+            if timeout is not None:
+                remaining = timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            try:
+                name, result = results.get(timeout=wait)
+            except queue.Empty:
+                if any(p.is_alive() for p in procs):
+                    continue
+                #every worker has exited: whatever they sent is in the
+                #queue by now
+                try:
+                    name, result = results.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if error is not None:
+                        raise error
+                    raise RuntimeError("every portfolio process exited without a result "
+                                       "(exit codes {})".format([p.exitcode for p in procs])) from None
+            if isinstance(result, BaseException):
+                failures += 1
+                error = result
+                if failures == len(procs):
+                    raise result
+                continue
+            result['config'] = name
+            result['portfolio_time'] = time.perf_counter() - start
+            if wins is not None:
+                wins[name] = wins.get(name, 0) + 1
+            return result
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join()
@@ -0,0 +1,384 @@
+'''Parallel backtracking search over a single CSP.
+
+   parallel_bt_search splits the search tree of one CSP between several
+   worker processes. A subproblem is a list of decisions (variable
+   index, value) to replay from the root, i.e. a list of domain
+   restrictions, together with its path in the search tree: the position
+   of each decision's value in the value ordering of its level.
+
+   Work stealing: a worker that runs out of subproblems posts a steal
+   request, a flag of its own in a shared array. Every few hundred
+   nodes, a busy worker checks for requests. If it finds one, it
+   consumes it and splits its open subtree: the untried values of its
+   shallowest open decision become new subproblems, and the worker
+   keeps searching the rest. A coordinator (the calling process) hands
+   out subproblems and collects results. Any idle worker may take the
+   subproblems a request produced, so a worker withdraws its own request
+   when it gets work, and posts it again if it is still idle a while
+   after its request was consumed.
+
+   parallel_bt_count counts solutions instead: every subproblem is
+   searched to the end (or until limit solutions) and the counts are
+   added up. Any variable ordering may be used for counting.
+
+   An exception in a worker (in make_csp or the propagator, say) is
+   sent to the coordinator and raised there, and a worker that dies
+   without reporting (e.g. killed) raises RuntimeError, so the search
+   never waits on a worker that cannot answer.
+
+   The solution returned is the one the sequential solver (BT.bt_search
+   with the same propagator and orderings) would find. Sequential search
+   visits paths in lexicographic order, so a solution is accepted only
+   once every subproblem whose path is smaller has been exhausted. This
+   requires the variable and value orderings to depend only on the
+   current state of the search, which holds for static ordering and
+   ord_mrv but not for ord_dom_wdeg (its weights depend on history).
+
+   The CSP is built in every worker by calling make_csp(*args), so it is
+   never pickled; make_csp may also return (csp, var_array) like the
+   Futoshiki models. propagator, var_ord and val_ord must be picklable
+   (module level functions).
+'''
+import multiprocessing
+import os
+import pickle
+import queue
+import traceback
+
+from cspbase import BT
+
+
+#seconds between the coordinator's checks that the workers are alive
+POLL_INTERVAL = 0.2
+
+#seconds an idle worker waits for work before posting its steal request
+#again, if the request was consumed but the work went to another worker
+REQUEST_INTERVAL = 0.2
+
+
+class StealingBT(BT):
+    '''BT whose search runs one subproblem at a time and can give away
+       the untried values of its shallowest open decision'''
+
+    def __init__(self, csp, steal_lock, steal_requests, requesters, split_interval):
+        BT.__init__(self, csp)
+        self.var_index = {var: i for i, var in enumerate(csp.vars)}
+        self.steal_lock = steal_lock
+        self.steal_requests = steal_requests
+        self.requesters = requesters
+        self.split_interval = split_interval
+
+    def run_task(self, prefix, key, propagator, var_ord, val_ord, spawn, counting=False, limit=None):
+        '''Replay the decisions of prefix from the root, then search the
+           subtree below them. spawn(list of (prefix, key)) is called to
+           hand subproblems back to the coordinator. Return the path key
+           and values of the first solution found, or None; if counting,
+           return the number of solutions in the subtree (at most limit)'''
+        self.csp.check_current()
+        self.restore_all_variable_domains()
+        self.trail.clear()
+        self.unasgn_vars = list(self.csp.vars)
+
+        status, prunings = propagator(self.csp)
+        self.trail.push_all(prunings)
+        for var_index, val in prefix:
+            if not status:
+                break
+            var = self.csp.vars[var_index]
+            if not var.in_cur_domain(val):
+                status = False
+                break
+            var.assign(val)
+            status, prunings = propagator(self.csp, var)
+            self.trail.push_all(prunings)
+        else:
+            if prefix:
+                self.nDecisions = self.nDecisions + 1  # the subproblem's own decision
+        if not status:
+            return 0 if counting else None
+        return self.search(prefix, key, propagator, var_ord, val_ord, spawn, counting, limit)
+
+    def search(self, prefix, key, propagator, var_ord, val_ord, spawn, counting=False, limit=None):
+        '''bt_iterate below the decisions of prefix, splitting off open
+           subtrees when another worker asks for work. If counting, go on
+           after each solution and return the number found'''
+        nvars = len(self.unasgn_vars)
+        base = len(prefix)
+        if base == nvars:
+            return 1 if counting else (key, self.solution_values())
+
+        count = 0
+        stack = [self.open_frame(var_ord, val_ord, base+1)]
+        nodes = 0
+        while stack:
+            level = base + len(stack)
+            frame = stack[-1]
+            var, value_order, pos, mark = frame
+
+            if var.is_assigned():
+                self.trail.undo_to(mark)
+                var.unassign()
+
+            if pos == len(value_order):
+                stack.pop()
+                continue
+
+            nodes += 1
+            if nodes % self.split_interval == 0 and self.steal_requests.value > 0:
+                self.split(stack, prefix, key, spawn)
+                value_order = frame[1]
+
+            val = value_order[pos]
+            frame[2] = pos + 1
+
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
+            status, prunings = propagator(self.csp, var)
+            self.nPrunings = self.nPrunings + len(prunings)
+            self.trail.push_all(prunings)
+            if not status:
+                self.record_conflict()
+
+            if status:
+                if level == nvars:
+                    if not counting:
+                        return key + [f[2] - 1 for f in stack], self.solution_values()
+                    count += 1
+                    if limit is not None and count >= limit:
+                        break
+                    continue
+                stack.append(self.open_frame(var_ord, val_ord, level+1))
+        return count if counting else None
+
+    def split(self, stack, prefix, key, spawn):
+        '''Give away the untried values of the shallowest frame that has
+           some, consuming a steal request if one is still pending'''
+        for depth, frame in enumerate(stack):
+            var, value_order, pos, mark = frame
+            #the top frame is about to try value_order[pos] itself
+            first = pos if depth < len(stack) - 1 else pos + 1
+            if first < len(value_order):
+                break
+        else:
+            return
+        with self.steal_lock:
+            for requester, pending in enumerate(self.requesters):
+                if pending:
+                    break
+            else:
+                return
+            self.requesters[requester] = 0
+            self.steal_requests.value -= 1
+
+        above = stack[:depth]
+        sub_prefix = prefix + [(self.var_index[f[0]], f[1][f[2]-1]) for f in above]
+        sub_key = key + [f[2] - 1 for f in above]
+        tasks = [(sub_prefix + [(self.var_index[var], value_order[j])], sub_key + [j])
+                 for j in range(first, len(value_order))]
+        frame[1] = value_order[:first]
+        if tasks:
+            spawn(tasks)
+
+    def solution_values(self):
+        return [var.get_assigned_value() for var in self.csp.vars]
+
+
+def build_csp(make_csp, args):
+    csp = make_csp(*args)
+    if isinstance(csp, tuple):
+        csp = csp[0]
+    return csp
+
+
+class RemoteTraceback(Exception):
+    '''Cause attached to an exception re-raised from a worker: the
+       traceback it had in the worker'''
+
+    def __init__(self, text):
+        Exception.__init__(self, text)
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+def post_request(worker, steal_lock, steal_requests, requesters):
+    '''Internal routine. Post the steal request of worker unless it is
+       pending already'''
+    with steal_lock:
+        if not requesters[worker]:
+            requesters[worker] = 1
+            steal_requests.value += 1
+
+
+def withdraw_request(worker, steal_lock, steal_requests, requesters):
+    '''Internal routine. Withdraw the steal request of worker if no
+       splitter has consumed it'''
+    with steal_lock:
+        if requesters[worker]:
+            requesters[worker] = 0
+            steal_requests.value -= 1
+
+
+def worker_main(worker, make_csp, args, propagator, var_ord, val_ord, counting, limit,
+                tasks, results, steal_lock, steal_requests, requesters, split_interval):
+    '''Worker process: solve subproblems from tasks until told to stop.
+       An exception is put on results as ('error', task id or None,
+       exception, traceback text)'''
+    task_id = None
+    try:
+        solver = StealingBT(build_csp(make_csp, args), steal_lock, steal_requests,
+                            requesters, split_interval)
+        while True:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                post_request(worker, steal_lock, steal_requests, requesters)
+                while True:
+                    try:
+                        task = tasks.get(timeout=REQUEST_INTERVAL)
+                        break
+                    except queue.Empty:
+                        #the work our request produced may have gone to
+                        #another idle worker
+                        post_request(worker, steal_lock, steal_requests, requesters)
+                withdraw_request(worker, steal_lock, steal_requests, requesters)
+            if task is None:
+                return
+            task_id, prefix, key = task
+
+            def spawn(subtasks):
+                results.put(('split', task_id, subtasks))
+
+            solver.clear_stats()
+            found = solver.run_task(prefix, key, propagator, var_ord, val_ord, spawn, counting, limit)
+            results.put(('done', task_id, found, solver.nDecisions, solver.nPrunings))
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError("{}: {}".format(type(e).__name__, e))
+        results.put(('error', task_id, e, traceback.format_exc()))
+
+
+def next_message(results, workers):
+    '''Internal routine. The next message from the workers. Raise the
+       exception a worker reported, or RuntimeError if a worker died
+       without reporting'''
+    while True:
+        try:
+            msg = results.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            dead = [w for w in workers if w.exitcode is not None]
+            if not dead:
+                continue
+            #a worker's last messages are in the queue once it has exited
+            try:
+                msg = results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                raise RuntimeError("parallel search worker exited with code {}".format(
+                    dead[0].exitcode)) from None
+        if msg[0] == 'error':
+            _, task_id, exc, text = msg
+            raise exc from RemoteTraceback(text)
+        return msg
+
+
+def start_workers(make_csp, args, propagator, var_ord, val_ord, counting, limit,
+                  processes, split_interval):
+    '''Internal routine. Start processes workers (os.cpu_count() by
+       default); return (workers, tasks, results)'''
+    if processes is None:
+        processes = os.cpu_count() or 1
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    steal_lock = multiprocessing.Lock()
+    steal_requests = multiprocessing.Value('i', 0, lock=False)
+    requesters = multiprocessing.Array('b', processes, lock=False)
+    workers = [multiprocessing.Process(target=worker_main,
+                                       args=(i, make_csp, args, propagator, var_ord, val_ord,
+                                             counting, limit, tasks, results, steal_lock,
+                                             steal_requests, requesters, split_interval),
+                                       daemon=True)
+               for i in range(processes)]
+    for w in workers:
+        w.start()
+    return workers, tasks, results
+
+
+def stop_workers(workers):
+    for w in workers:
+        w.terminate()
+    for w in workers:
+        w.join()
+
+
+def parallel_bt_search(make_csp, args=(), propagator=None, var_ord=None, val_ord=None,
+                       processes=None, split_interval=256):
+    '''Solve the CSP built by make_csp(*args) with processes workers
+       (os.cpu_count() by default) sharing the search tree. Returns
+       (values, stats): values is the list of the values of the first
+       solution (in the order of csp.vars) or None if there is none, and
+       stats a dict with the total 'nDecisions', 'nPrunings' and the
+       number of 'subproblems' solved'''
+    workers, tasks, results = start_workers(make_csp, args, propagator, var_ord, val_ord,
+                                            False, None, processes, split_interval)
+    stats = {'nDecisions': 0, 'nPrunings': 0, 'subproblems': 0}
+    open_keys = {0: []}    # task id -> path key of unfinished subproblems
+    next_id = 1
+    best = None            # (key, values) of leftmost solution found so far
+    tasks.put((0, [], []))
+    try:
+        while open_keys:
+            if best is not None and all(k > best[0] for k in open_keys.values()):
+                break
+            msg = next_message(results, workers)
+            if msg[0] == 'split':
+                for prefix, key in msg[2]:
+                    open_keys[next_id] = key
+                    tasks.put((next_id, prefix, key))
+                    next_id += 1
+            else:
+                _, task_id, found, n_decisions, n_prunings = msg
+                del open_keys[task_id]
+                stats['nDecisions'] += n_decisions
+                stats['nPrunings'] += n_prunings
+                stats['subproblems'] += 1
+                if found is not None and (best is None or found[0] < best[0]):
+                    best = found
+    finally:
+        stop_workers(workers)
+    return (best[1] if best is not None else None), stats
+
+
+def parallel_bt_count(make_csp, args=(), propagator=None, var_ord=None, val_ord=None,
+                      processes=None, limit=None, split_interval=256):
+    '''Count the solutions of the CSP built by make_csp(*args) with
+       processes workers sharing the search tree, stopping once limit
+       solutions are found. Returns (count, stats), count being what
+       BT.bt_count would return and stats as for parallel_bt_search'''
+    workers, tasks, results = start_workers(make_csp, args, propagator, var_ord, val_ord,
+                                            True, limit, processes, split_interval)
+    stats = {'nDecisions': 0, 'nPrunings': 0, 'subproblems': 0}
+    open_ids = {0}         # ids of unfinished subproblems
+    next_id = 1
+    count = 0
+    tasks.put((0, [], []))
+    try:
+        while open_ids and (limit is None or count < limit):
+            msg = next_message(results, workers)
+            if msg[0] == 'split':
+                for prefix, key in msg[2]:
+                    open_ids.add(next_id)
+                    tasks.put((next_id, prefix, key))
+                    next_id += 1
+            else:
+                _, task_id, found, n_decisions, n_prunings = msg
+                open_ids.discard(task_id)
+                stats['nDecisions'] += n_decisions
+                stats['nPrunings'] += n_prunings
+                stats['subproblems'] += 1
+                count += found
+    finally:
+        stop_workers(workers)
+    return (count if limit is None else min(count, limit)), stats
@@ -71,6 +71,15 @@ var_ordering == a function with the following template
     var_ordering returns the next Variable to be assigned, as per the definition
     of the heuristic it implements.
    '''
+from collections import deque
+from itertools import repeat
+from operator import itemgetter
+import weakref
+
+try:
+    import numpy
+except ImportError:  # numpy is only needed by prop_FC_numpy
+    numpy = None
 
 
 def prop_BT(csp, newVar=None):
@@ -79,23 +88,21 @@ def prop_BT(csp, newVar=None):
 
     if not newVar:
         return True, []
+    hooks = csp.hooks
     for c in csp.get_cons_with_var(newVar):
         if c.get_n_unasgn() == 0:
+            if hooks is not None:
+                hooks.revision(csp, c)
             vals = []
             vars = c.get_scope()
             for var in vars:
                 vals.append(var.get_assigned_value())
             if not c.check(vals):
+                csp.conflict = c
                 return False, []
     return True, []
 
 
-def prop_FC_helper(lst, variable, value, c):
-    for i in range(len(lst)):
-        if variable == c.get_scope()[i]:
-            lst[i] = value
-            break
-
 def prop_FC(csp, newVar=None):
     '''Do forward checking. That is check constraints with
        only one uninstantiated variable. Remember to keep
@@ -105,24 +112,232 @@ def prop_FC(csp, newVar=None):
     else:
         constraints = csp.get_cons_with_var(newVar)
     pruned = []
+    hooks = csp.hooks
     for c in constraints:
         if c.get_n_unasgn() == 1:
-            var = c.get_unasgn_vars()[0]
+            if hooks is not None:
+                hooks.revision(csp, c)
+            pos = c.unasgn_pos_sum
+            var = c.get_last_unasgn_var()
+            if c.mask_based:
+                removed = c.forward_check()
+                for value in removed:
+                    pruned.append((var, value))
+                if removed and var.cur_domain_size() == 0:
+                    csp.conflict = c
+                    return False, pruned
+                continue
             # For that constraint we have to get all the scope
             lst = []
             for scope in c.get_scope():
                 lst.append(scope.get_assigned_value())
             for value in var.cur_domain():
-                prop_FC_helper(lst, var, value, c)
+                lst[pos] = value
                 if not c.check(lst):
                     var.prune_value(value)
                     pruned.append((var, value))
 
                     if var.cur_domain_size() == 0:
+                        csp.conflict = c
                         return False, pruned
     return True, pruned
 
 
+class CompatMatrix:
+    '''Boolean compatibility matrix of a binary table constraint for
+       prop_FC_numpy: rows[0][a] (rows[1][b]) is the boolean array, over
+       the domain indices of the second (first) variable of the scope, of
+       the values compatible with the a-th (b-th) domain value of the
+       first (second) variable. The matrix is shared by the constraints
+       over the same table and domains'''
+
+    #table -> {(domain of scope[0], domain of scope[1]): CompatMatrix}
+    shared = weakref.WeakKeyDictionary()
+
+    def __init__(self, constraint):
+        x, y = constraint.get_scope()
+        matrix = numpy.zeros((x.domain_size(), y.domain_size()), dtype=bool)
+        tuples = list(constraint.sat_tuples)
+        #domain indices of the values in each tuple, -1 outside the domain
+        rows = numpy.fromiter(map(x.dom_index.get, map(itemgetter(0), tuples), repeat(-1)),
+                              dtype=numpy.intp, count=len(tuples))
+        cols = numpy.fromiter(map(y.dom_index.get, map(itemgetter(1), tuples), repeat(-1)),
+                              dtype=numpy.intp, count=len(tuples))
+        keep = (rows >= 0) & (cols >= 0)
+        matrix[rows[keep], cols[keep]] = True
+        self.rows = (matrix, numpy.ascontiguousarray(matrix.T))
+
+    @classmethod
+    def of(cls, constraint):
+        '''the CompatMatrix of constraint, compiled on first use'''
+        m = compat_matrices.get(constraint)
+        if m is None:
+            x, y = constraint.scope
+            by_domains = cls.shared.setdefault(constraint.table, dict())
+            key = (tuple(x.dom), tuple(y.dom))
+            m = by_domains.get(key)
+            if m is None:
+                m = by_domains[key] = cls(constraint)
+            compat_matrices[constraint] = m
+        return m
+
+
+#binary table constraint -> its CompatMatrix
+compat_matrices = weakref.WeakKeyDictionary()
+
+
+def is_binary_table(c):
+    return c.table_based and len(c.scope) == 2 and c.scope[0] is not c.scope[1]
+
+
+class FCNeighbourhood:
+    '''The binary table constraints over a variable V of a CSP, compiled
+       for prop_FC_numpy. rows[a] stacks, for each of them, the boolean
+       array of the values of its other variable compatible with the a-th
+       domain value of V (padded with False to a common width). Forward
+       checking all of them after V is assigned takes one unpacking of
+       the domain bitmasks of the other variables, one AND and one
+       nonzero'''
+
+    def __init__(self, var, constraints):
+        self.constraints = list(constraints)
+        #position in constraints -> row of the stack, for binary tables
+        self.binary = dict()
+        self.others = []
+        matrices = []
+        for k, c in enumerate(self.constraints):
+            if is_binary_table(c):
+                pos = c.var_pos[var]
+                self.binary[k] = len(self.others)
+                self.others.append(c.scope[1 - pos])
+                matrices.append(CompatMatrix.of(c).rows[pos])
+        self.width = max([m.shape[1] for m in matrices], default=0)
+        self.nbytes = (self.width + 7) // 8
+        self.rows = numpy.zeros((var.domain_size(), len(matrices), self.width), dtype=bool)
+        for b, m in enumerate(matrices):
+            self.rows[:, b, :m.shape[1]] = m
+
+    @staticmethod
+    def of(csp, var):
+        '''the FCNeighbourhood of var in csp, compiled again if the
+           constraints over var changed'''
+        by_var = fc_neighbourhoods.get(csp)
+        if by_var is None:
+            by_var = fc_neighbourhoods[csp] = dict()
+        nb = by_var.get(var)
+        if nb is None or nb.constraints != csp.vars_to_cons[var]:
+            nb = by_var[var] = FCNeighbourhood(var, csp.vars_to_cons[var])
+        return nb
+
+    def removals(self, value_index):
+        '''dict: row of the stack -> list of the domain indices of the
+           current values of its other variable that are incompatible
+           with the value_index-th value of V. Only rows whose other
+           variable is unassigned are computed'''
+        others = self.others
+        active = [b for b in range(len(others)) if not others[b].is_assigned()]
+        if not active:
+            return {}
+        nbytes = self.nbytes
+        raw = b''.join([others[b].curdom.to_bytes(nbytes, 'little') for b in active])
+        doms = numpy.unpackbits(numpy.frombuffer(raw, dtype=numpy.uint8).reshape(len(active), nbytes),
+                                axis=1, count=self.width, bitorder='little').view(bool)
+        ks, idx = numpy.nonzero(doms & ~self.rows[value_index][active])
+        removed = dict()
+        for k, i in zip(ks.tolist(), idx.tolist()):
+            removed.setdefault(active[k], []).append(i)
+        return removed
+
+
+#csp -> {Variable: FCNeighbourhood}
+fc_neighbourhoods = weakref.WeakKeyDictionary()
+
+
+def prop_FC_numpy(csp, newVar=None):
+    '''Forward checking like prop_FC, with the same result (status,
+       prunings in the same order). After an assignment, the binary table
+       constraints over newVar are checked together with NumPy (see
+       FCNeighbourhood) instead of value by value; other constraints are
+       checked as in prop_FC, and so is the root. Requires numpy'''
+    if numpy is None:
+        raise ImportError("prop_FC_numpy requires numpy")
+    if not newVar:
+        return prop_FC(csp)
+    nb = FCNeighbourhood.of(csp, newVar)
+    removed = nb.removals(newVar.value_index(newVar.get_assigned_value()))
+    pruned = []
+    hooks = csp.hooks
+    for k, c in enumerate(nb.constraints):
+        if c.get_n_unasgn() == 1:
+            if hooks is not None:
+                hooks.revision(csp, c)
+            var = c.get_last_unasgn_var()
+            b = nb.binary.get(k)
+            if b is not None:
+                #an earlier constraint over var may have pruned some of
+                #the values since removals() looked at the domain
+                any_pruned = False
+                for i in removed.get(b, ()):
+                    if var.curdom >> i & 1:
+                        value = var.dom[i]
+                        var.prune_value(value)
+                        pruned.append((var, value))
+                        any_pruned = True
+                if any_pruned and var.cur_domain_size() == 0:
+                    csp.conflict = c
+                    return False, pruned
+                continue
+            pos = c.unasgn_pos_sum
+            lst = []
+            for scope in c.get_scope():
+                lst.append(scope.get_assigned_value())
+            for value in var.cur_domain():
+                lst[pos] = value
+                if not c.check(lst):
+                    var.prune_value(value)
+                    pruned.append((var, value))
+
+                    if var.cur_domain_size() == 0:
+                        csp.conflict = c
+                        return False, pruned
+    return True, pruned
+
+
+class GACQueue:
+    '''FIFO queue of constraints waiting to be revised by GAC. push, pop
+       and membership tests are all O(1): a constraint's in_queue flag is
+       set while it is on the queue, so it is never queued twice.'''
+
+    def __init__(self, constraints=()):
+        self.items = deque()
+        for c in constraints:
+            self.push(c)
+
+    def push(self, c):
+        '''add c to the back of the queue unless it is already queued'''
+        if not c.in_queue:
+            c.in_queue = True
+            self.items.append(c)
+
+    def pop(self):
+        '''remove and return the constraint at the front of the queue'''
+        c = self.items.popleft()
+        c.in_queue = False
+        return c
+
+    def clear(self):
+        '''empty the queue (e.g. after a deadend), resetting the flags'''
+        for c in self.items:
+            c.in_queue = False
+        self.items.clear()
+
+    def __contains__(self, c):
+        return c.in_queue
+
+    def __len__(self):
+        return len(self.items)
+
+
 def prop_GAC(csp, newVar=None):
     '''Do GAC propagation. If newVar is None we do initial GAC enforce
        processing all constraints. Otherwise, we do GAC enforce with
@@ -130,18 +345,31 @@ def prop_GAC(csp, newVar=None):
 
     pruned = []
     if newVar is None:
-        queue = csp.get_all_cons()
+        queue = GACQueue(csp.get_all_cons())
     else:
-        queue = csp.get_cons_with_var(newVar)
+        queue = GACQueue(csp.get_cons_with_var(newVar))
+    hooks = csp.hooks
     while queue:
-        boolean, pruned = prop_GAC_Helper(csp, queue.pop(0), queue, [])
+        c = queue.pop()
+        if hooks is not None:
+            hooks.revision(csp, c)
+        boolean, pruned = prop_GAC_Helper(csp, c, queue, pruned)
         if not boolean:
+            queue.clear()
+            csp.conflict = c
             return False, pruned
     return True, pruned
 
 
 def prop_GAC_Helper(csp, constraint, queue, pruned):
-    '''gac helper'''
+    '''gac helper. Revises constraint, and pushes on queue every other
+       constraint over a variable that lost a value. constraint itself is
+       not requeued: a value it prunes has no valid support tuple, so
+       removing it cannot invalidate any of its remaining supports'''
+    result = constraint.filter()
+    if result is not None:
+        # the constraint supplies its own GAC filtering routine
+        return prop_filtered(csp, constraint, queue, pruned, result)
     for scope in constraint.get_scope():
         for curr_elem in scope.cur_domain():
             if not constraint.has_support(scope, curr_elem):
@@ -150,19 +378,195 @@ def prop_GAC_Helper(csp, constraint, queue, pruned):
                 if scope.cur_domain_size() == 0:
                     return False, pruned
                 for cons in csp.get_cons_with_var(scope):
-                    if cons not in queue:
-                        queue.append(cons)
+                    if cons is not constraint:
+                        queue.push(cons)
+    return True, pruned
+
+
+def prop_filtered(csp, constraint, queue, pruned, result):
+    '''Record the (status, prunings) result of a constraint's own
+       filtering routine: extend pruned, and queue every other constraint
+       over a variable that lost a value'''
+    status, filtered = result
+    for scope, curr_elem in filtered:
+        pruned.append((scope, curr_elem))
+        for cons in csp.get_cons_with_var(scope):
+            if cons is not constraint:
+                queue.push(cons)
+    if not status:
+        return False, pruned
+    for scope, curr_elem in filtered:
+        if scope.cur_domain_size() == 0:
+            return False, pruned
+    return True, pruned
+
+
+def bits(mask):
+    '''iterate over the positions of the set bits of mask, lowest first'''
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class CompactTable:
+    '''Compact-Table (CT) filtering state for one table constraint.
+
+       The satisfying tuples of the constraint are numbered, and sets of
+       tuples are Python ints used as bitsets, so intersecting them is a
+       single word-parallel operation. supports[i][a] is the set of tuples
+       whose i-th value is the a-th domain value of scope[i], and the
+       current table is the set of tuples all of whose values are still in
+       the current domains.
+
+       The current table is reversible without any hook into
+       backtracking: after each revision the state (current domain masks,
+       table) is pushed on a stack. On the next revision, states whose
+       domains are not supersets of the current domains (i.e. states that
+       search has backtracked out of) are popped, and the table of the
+       topmost remaining state is brought up to date from the values
+       removed since it was saved.'''
+
+    def __init__(self, constraint):
+        self.scope = constraint.get_scope()
+        self.supports = [[0] * var.domain_size() for var in self.scope]
+        self.full = 0
+        for k, t in enumerate(constraint.sat_tuples):
+            idxs = [var.dom_index.get(val) for var, val in zip(self.scope, t)]
+            if None in idxs:
+                continue  # uses a value outside the domains, never valid
+            bit = 1 << k
+            self.full |= bit
+            for i, a in enumerate(idxs):
+                self.supports[i][a] |= bit
+        self.dom_masks = [(1 << var.domain_size()) - 1 for var in self.scope]
+        self.saved = []
+
+    def revise(self):
+        '''Make the constraint GAC. Returns (True/False, [(Variable, Value), ...])'''
+        masks = [var.cur_domain_mask() for var in self.scope]
+
+        #restore the table of the deepest saved state still valid
+        saved = self.saved
+        while saved:
+            old_masks, table = saved[-1]
+            if all(not m & ~o for m, o in zip(masks, old_masks)):
+                break
+            saved.pop()
+        else:
+            old_masks, table = self.dom_masks, self.full
+
+        #remove the tuples that use a value removed since then, either
+        #incrementally (few removed values) or by reset (few left)
+        for i, m in enumerate(masks):
+            removed = old_masks[i] & ~m
+            if not removed:
+                continue
+            sup = self.supports[i]
+            union = 0
+            if bin(removed).count("1") <= bin(m).count("1"):
+                for a in bits(removed):
+                    union |= sup[a]
+                table &= ~union
+            else:
+                for a in bits(m):
+                    union |= sup[a]
+                table &= union
+            if not table:
+                return False, []
+
+        #a value is GAC iff some tuple of the current table uses it
+        pruned = []
+        for i, var in enumerate(self.scope):
+            if var.is_assigned():
+                continue
+            sup = self.supports[i]
+            for a in bits(masks[i]):
+                if not table & sup[a]:
+                    val = var.dom[a]
+                    var.prune_value(val)
+                    pruned.append((var, val))
+                    masks[i] &= ~(1 << a)
+
+        if saved and saved[-1][0] == masks:
+            saved[-1] = (masks, table)
+        else:
+            saved.append((masks, table))
+        return True, pruned
+
+
+#CompactTable state of each table constraint, built on first use
+compact_tables = weakref.WeakKeyDictionary()
+
+
+def prop_CT(csp, newVar=None):
+    '''Do GAC propagation like prop_GAC, but revise table constraints
+       with Compact-Table (see CompactTable). Other constraints, and
+       BinaryConstraints (whose support masks are cheaper than a
+       CompactTable), are revised as in prop_GAC'''
+
+    pruned = []
+    if newVar is None:
+        queue = GACQueue(csp.get_all_cons())
+    else:
+        queue = GACQueue(csp.get_cons_with_var(newVar))
+    hooks = csp.hooks
+    while queue:
+        c = queue.pop()
+        if hooks is not None:
+            hooks.revision(csp, c)
+        if c.table_based and not c.mask_based:
+            ct = compact_tables.get(c)
+            if ct is None:
+                ct = compact_tables[c] = CompactTable(c)
+            boolean, pruned = prop_filtered(csp, c, queue, pruned, ct.revise())
+        else:
+            boolean, pruned = prop_GAC_Helper(csp, c, queue, pruned)
+        if not boolean:
+            queue.clear()
+            csp.conflict = c
+            return False, pruned
     return True, pruned
 
 
 def ord_mrv(csp):
-    ''' return variable according to the Minimum Remaining Values heuristic '''
-    unassigned = csp.get_all_unasgn_vars()
-    min_size = float('inf')
+    ''' return variable according to the Minimum Remaining Values heuristic.
+    Ties go to the variable that comes last in the CSP. Uses the CSP's
+    DomainBuckets, so no scan over the unassigned variables is needed '''
+    return csp.domain_buckets().min_var()
+
+
+def ord_dom_wdeg(csp):
+    ''' return variable minimizing current domain size / weighted degree,
+    where the weighted degree of a variable is the sum of the conflict
+    weights of its constraints that have another unassigned variable.
+    Constraint weights grow as BT hits deadends caused by them '''
+    min_score = float('inf')
     min_var = None
-    for elem in unassigned:
-        if elem.cur_domain_size() <= min_size:
-            min_size = elem.cur_domain_size()
+    for elem in csp.get_all_unasgn_vars():
+        wdeg = 0
+        for c in csp.vars_to_cons[elem]:
+            if c.get_n_unasgn() > 1:
+                wdeg += c.weight
+        score = elem.cur_domain_size() / wdeg if wdeg else float('inf')
+        if score <= min_score:
+            min_score = score
             min_var = elem
     return min_var
 
+
+def ord_dom_ddeg(csp):
+    ''' return variable minimizing current domain size / dynamic degree,
+    the number of its constraints that have another unassigned variable '''
+    min_score = float('inf')
+    min_var = None
+    for elem in csp.get_all_unasgn_vars():
+        ddeg = 0
+        for c in csp.vars_to_cons[elem]:
+            if c.get_n_unasgn() > 1:
+                ddeg += 1
+        score = elem.cur_domain_size() / ddeg if ddeg else float('inf')
+        if score <= min_score:
+            min_score = score
+            min_var = elem
+    return min_var
@@ -0,0 +1,167 @@
+'''Regression checks for the search extensions, in the style of
+   autograder.py: each check returns (score, details) and the totals are
+   printed when run as a script.
+
+       python regression_checks.py
+'''
+import random
+import traceback
+
+from cspbase import *
+from propagators import *
+from futoshiki_csp import *
+import futoshiki_parallel
+import parallel_search
+from backjumping import CBJ
+from benchmark import random_futoshiki
+from autograder import nQueens
+
+
+def check_template_superseded():
+    '''A CSP from an earlier instantiate of a template refuses to search,
+       and the current one solves its own board'''
+    score = 0
+    try:
+        b1 = [[0, '<', 0, '<', 0], [0, '.', 0, '.', 0], [0, '.', 0, '.', 0]]
+        b2 = [[3, '.', 0, '.', 0], [0, '.', 0, '.', 0], [0, '.', 0, '.', 0]]
+        csp1, _ = futoshiki_csp_from_template(b1)
+        csp2, var_array = futoshiki_csp_from_template(b2)
+        try:
+            BT(csp1).bt_search(prop_FC)
+            details = "Failed template check: a superseded CSP was searched"
+        except RuntimeError:
+            result = BT(csp2).bt_search(prop_FC)
+            if result and result.values(var_array)[0][0] == 3:
+                score = 1
+                details = ""
+            else:
+                details = "Failed template check: wrong solution for the current board"
+    except Exception:
+        details = "One or more runtime errors occurred in the template check: %r" % traceback.format_exc()
+    return score, details
+
+
+def check_portfolio_failures():
+    '''solve_portfolio rejects an empty portfolio and raises, instead of
+       waiting forever, when every configuration fails'''
+    score = 0
+    board = [[0, '<', 0, '.', 0], [0, '.', 0, '.', 0], [0, '.', 0, '>', 0]]
+    try:
+        try:
+            futoshiki_parallel.solve_portfolio(board, {})
+            return score, "Failed portfolio check: an empty portfolio was accepted"
+        except ValueError:
+            pass
+        try:
+            futoshiki_parallel.solve_portfolio(board, {'bad': (3, 'GAC', 'mrv')}, timeout=60)
+            return score, "Failed portfolio check: a failing configuration returned"
+        except ValueError:
+            pass
+        result = futoshiki_parallel.solve_portfolio(board, timeout=60)
+        if result is None or result['config'] not in futoshiki_parallel.DEFAULT_PORTFOLIO:
+            return score, "Failed portfolio check: no result from the default portfolio"
+        score = 1
+        details = ""
+    except Exception:
+        details = "One or more runtime errors occurred in the portfolio check: %r" % traceback.format_exc()
+    return score, details
+
+
+def failing_csp(n):
+    raise RuntimeError("make_csp failed on purpose")
+
+
+def check_parallel_search():
+    '''parallel_bt_search finds the solution bt_search finds, and
+       parallel_bt_count the count of bt_count, on n-queens with frequent
+       splitting; an exception in the workers reaches the caller'''
+    score = 0
+    try:
+        for n in range(6, 9):
+            for propagator, var_ord in ((prop_FC, ord_mrv), (prop_GAC, None)):
+                csp = nQueens(n)
+                result = BT(csp).bt_search(propagator, var_ord)
+                expected = [result.assignment[v] for v in csp.vars]
+                values, stats = parallel_search.parallel_bt_search(
+                    nQueens, (n,), propagator, var_ord, processes=3, split_interval=4)
+                if values != expected:
+                    return score, "Failed parallel check: {}-queens solution differs from bt_search".format(n)
+                count = BT(nQueens(n)).bt_count(propagator, var_ord)
+                total, stats = parallel_search.parallel_bt_count(
+                    nQueens, (n,), propagator, var_ord, processes=3, split_interval=4)
+                if total != count:
+                    return score, "Failed parallel check: {}-queens count {} instead of {}".format(n, total, count)
+        try:
+            parallel_search.parallel_bt_search(failing_csp, (4,), prop_FC, processes=2)
+            return score, "Failed parallel check: a worker exception was not raised"
+        except RuntimeError:
+            pass
+        score = 1
+        details = ""
+    except Exception:
+        details = "One or more runtime errors occurred in the parallel check: %r" % traceback.format_exc()
+    return score, details
+
+
+def satisfies(csp, assignment):
+    return all(c.check([assignment[v] for v in c.get_scope()]) for c in csp.get_all_cons())
+
+
+def check_backjumping():
+    '''CBJ (with and without nogoods, and with a tiny nogood store) counts
+       the same solutions as BT, and finds a valid solution exactly when
+       BT finds one, on n-queens and on seeded Futoshiki boards, some
+       made unsolvable by flipping an inequality'''
+    score = 0
+    weak = ((prop_FC, None), (prop_FC, ord_mrv), (prop_GAC, ord_dom_wdeg))
+    strong = ((prop_GAC, None), (prop_GAC, ord_mrv))
+    try:
+        problems = [("{}-queens".format(n), lambda n=n: nQueens(n), weak) for n in range(6, 9)]
+        rng = random.Random(25)
+        for k in range(12):
+            board = random_futoshiki(5, rng.choice([0.1, 0.2]), 0.4, rng)
+            if k % 3 == 0:
+                row = board[rng.randrange(5)]
+                for j in range(1, len(row), 2):
+                    if row[j] != '.':
+                        row[j] = '<' if row[j] == '>' else '>'
+                        break
+            #model 2 only propagates its all-different constraints well with GAC
+            problems.append(("board {} model 1".format(k),
+                             lambda board=board: futoshiki_csp_model_1(board)[0], weak))
+            problems.append(("board {} model 2".format(k),
+                             lambda board=board: futoshiki_csp_model_2(board)[0], strong))
+
+        for name, make, configs in problems:
+            for propagator, var_ord in configs:
+                count = BT(make()).bt_count(propagator, var_ord, limit=20)
+                expected = BT(make()).bt_search(propagator, var_ord)
+                for options in ({}, {'nogoods': False}, {'capacity': 4}):
+                    if CBJ(make(), **options).bt_count(propagator, var_ord, limit=20) != count:
+                        return score, "Failed backjumping check: {} {} {} counts differ".format(
+                            name, propagator.__name__, options)
+                    csp = make()
+                    result = CBJ(csp, **options).bt_search(propagator, var_ord)
+                    if result.status != expected.status or (result and not satisfies(csp, result.assignment)):
+                        return score, "Failed backjumping check: {} {} {} search differs".format(
+                            name, propagator.__name__, options)
+        score = 1
+        details = ""
+    except Exception:
+        details = "One or more runtime errors occurred in the backjumping check: %r" % traceback.format_exc()
+    return score, details
+
+
+CHECKS = [check_template_superseded, check_portfolio_failures, check_parallel_search,
+          check_backjumping]
+
+
+if __name__ == "__main__":
+    total = 0
+    for check in CHECKS:
+        print(check.__name__)
+        score, details = check()
+        total += score
+        print(details)
+        print("=======================================================")
+    print("Total score on regression checks: %d/%d\n" % (total, len(CHECKS)))
@@ -0,0 +1,171 @@
+'''Instrumentation hooks for BT and the propagators.
+
+   A hooks object is attached with BT.set_hooks(hooks) (BT.trace_on()
+   attaches a TraceHooks). BT then calls its methods on the search
+   events below, and the propagators call revision() each time they
+   revise a constraint. When no hooks are attached, each event costs a
+   single test against None.
+
+      search_start(solver, propagator)    root propagation is about to run
+      node(solver, level, var)            var picked for a decision at level
+      value_tried(solver, level, var, val)
+      propagation_start(solver, level, var)
+      propagation_end(solver, level, var, status, prunings)
+                                          csp.conflict is still set if
+                                          status is False
+      revision(csp, constraint)           called by the propagators
+      backtrack(solver, level, var, mark) the value of var is about to be
+                                          undone; solver.trail.since(mark)
+                                          are the prunings being restored
+      solution(solver, level)
+      search_end(solver, status)
+
+   Level 0 is the root propagation, level 1 the first decision.
+'''
+import json
+import time
+
+
+class SearchHooks:
+    '''Base class of hooks objects: every event is ignored. Subclasses
+       override the events they care about'''
+
+    def search_start(self, solver, propagator):
+        pass
+
+    def node(self, solver, level, var):
+        pass
+
+    def value_tried(self, solver, level, var, val):
+        pass
+
+    def propagation_start(self, solver, level, var):
+        pass
+
+    def propagation_end(self, solver, level, var, status, prunings):
+        pass
+
+    def revision(self, csp, constraint):
+        pass
+
+    def backtrack(self, solver, level, var, mark):
+        pass
+
+    def solution(self, solver, level):
+        pass
+
+    def search_end(self, solver, status):
+        pass
+
+
+class TraceHooks(SearchHooks):
+    '''Print a trace of the search to stdout (what BT.TRACE used to do)'''
+
+    def search_start(self, solver, propagator):
+        print(len(solver.unasgn_vars), " unassigned variables at start of search")
+
+    def node(self, solver, level, var):
+        print('  ' * level, "bt_recurse level ", level)
+        print('  ' * level, "bt_recurse var = ", var)
+
+    def value_tried(self, solver, level, var, val):
+        print('  ' * level, "bt_recurse trying", var, "=", val)
+
+    def propagation_end(self, solver, level, var, status, prunings):
+        if level == 0:
+            print("Root Prunings: ", prunings)
+        else:
+            print('  ' * level, "bt_recurse prop status = ", status)
+            print('  ' * level, "bt_recurse prop pruned = ", prunings)
+
+    def backtrack(self, solver, level, var, mark):
+        print('  ' * level, "bt_recurse restoring ", solver.trail.since(mark))
+
+
+class StatsCollector(SearchHooks):
+    '''Aggregate statistics over one or more searches:
+
+       revisions        constraint name -> number of revisions
+       conflicts        constraint name -> number of deadends blamed on it
+       propagators      propagator name -> {'calls', 'time', 'prunings',
+                                            'failures'}
+       nodes_by_depth   level -> number of values tried
+       failures_by_depth  level -> number of failed propagations
+       backtracks, solutions, searches
+
+       as_dict() returns all of it (with failure rates) and to_json()
+       exports it'''
+
+    def __init__(self):
+        self.revisions = {}
+        self.conflicts = {}
+        self.propagators = {}
+        self.nodes_by_depth = {}
+        self.failures_by_depth = {}
+        self.backtracks = 0
+        self.solutions = 0
+        self.searches = 0
+        self.current = None
+        self.started = 0.0
+
+    def search_start(self, solver, propagator):
+        self.searches += 1
+        name = getattr(propagator, '__name__', str(propagator))
+        self.current = self.propagators.get(name)
+        if self.current is None:
+            self.current = self.propagators[name] = {'calls': 0, 'time': 0.0,
+                                                     'prunings': 0, 'failures': 0}
+
+    def value_tried(self, solver, level, var, val):
+        self.nodes_by_depth[level] = self.nodes_by_depth.get(level, 0) + 1
+
+    def propagation_start(self, solver, level, var):
+        self.started = time.perf_counter()
+
+    def propagation_end(self, solver, level, var, status, prunings):
+        stats = self.current
+        stats['time'] += time.perf_counter() - self.started
+        stats['calls'] += 1
+        stats['prunings'] += len(prunings)
+        if not status:
+            stats['failures'] += 1
+            self.failures_by_depth[level] = self.failures_by_depth.get(level, 0) + 1
+            conflict = solver.csp.conflict
+            if conflict is not None:
+                self.conflicts[conflict.name] = self.conflicts.get(conflict.name, 0) + 1
+
+    def revision(self, csp, constraint):
+        self.revisions[constraint.name] = self.revisions.get(constraint.name, 0) + 1
+
+    def backtrack(self, solver, level, var, mark):
+        self.backtracks += 1
+
+    def solution(self, solver, level):
+        self.solutions += 1
+
+    def as_dict(self):
+        '''all statistics as a dict of JSON serializable values'''
+        propagators = {}
+        for name, stats in self.propagators.items():
+            stats = dict(stats)
+            stats['failure_rate'] = stats['failures'] / stats['calls'] if stats['calls'] else 0.0
+            propagators[name] = stats
+        depths = sorted(set(self.nodes_by_depth) | set(self.failures_by_depth))
+        return {'searches': self.searches,
+                'solutions': self.solutions,
+                'backtracks': self.backtracks,
+                'propagators': propagators,
+                'depth_histogram': {str(d): {'nodes': self.nodes_by_depth.get(d, 0),
+                                             'failures': self.failures_by_depth.get(d, 0)}
+                                    for d in depths},
+                'revisions': dict(sorted(self.revisions.items(), key=lambda kv: -kv[1])),
+                'conflicts': dict(sorted(self.conflicts.items(), key=lambda kv: -kv[1]))}
+
+    def to_json(self, path=None, indent=1):
+        '''Return the statistics as a JSON string, also writing it to the
+           file path if given'''
+        text = json.dumps(self.as_dict(), indent=indent)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text